@@ -0,0 +1,317 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Benchmarks for the GBS source service
+
+Generates synthetic git repositories of configurable scale and runs the
+service against them through file:// URLs, with a cold and a warm repository
+cache. Per-phase timings are collected with the metrics-file feature of the
+service and can be compared against a stored baseline for catching
+performance regressions.
+
+Run from the top of the source tree:
+    $ python benchmarks/bench_export.py [--scenario NAME] [--save-baseline]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+# pylint: disable=C0413
+from obs_service_gbs.command import main as service_main
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Repository shapes: history depth, number of files, number of packaging
+# patches, number of tags and number of Gerrit-style refs/changes
+SCENARIOS = {
+    'small': {'depth': 10, 'files': 20, 'patches': 2, 'tags': 2,
+              'changes': 10},
+    'medium': {'depth': 1000, 'files': 2000, 'patches': 20, 'tags': 50,
+               'changes': 2000},
+    'large': {'depth': 10000, 'files': 20000, 'patches': 100, 'tags': 500,
+              'changes': 30000},
+}
+
+SPEC_TEMPLATE = """Name:       bench-package
+Summary:    Synthetic package for benchmarking obs-service-gbs
+Version:    1.0
+Release:    0
+Group:      Development/Libraries
+License:    GPL-2.0
+Source:     %{name}-%{version}.tar.bz2
+
+%description
+Synthetic package for benchmarking obs-service-gbs.
+
+%prep
+%setup -q
+
+%build
+
+%install
+
+%files
+%defattr(-,root,root,-)
+"""
+
+
+class FastImport(object):
+    """Writer of a git fast-import stream"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.mark = 0
+        self.time = 1262304000
+
+    def _data(self, data):
+        """Write a data block"""
+        self.stream.write('data %d\n%s\n' % (len(data), data))
+
+    def commit(self, ref, message, files, parent=None):
+        """Write a commit, returns its mark"""
+        self.mark += 1
+        self.time += 60
+        self.stream.write('commit %s\nmark :%d\n' % (ref, self.mark))
+        self.stream.write('committer Bench <bench@example.com> %d +0000\n' %
+                          self.time)
+        self._data(message)
+        if parent:
+            self.stream.write('from :%d\n' % parent)
+        for path, content in files:
+            self.stream.write('M 100644 inline %s\n' % path)
+            self._data(content)
+        return self.mark
+
+    def tag(self, name, mark, message):
+        """Write an annotated tag"""
+        self.stream.write('tag %s\nfrom :%d\n' % (name, mark))
+        self.stream.write('tagger Bench <bench@example.com> %d +0000\n' %
+                          self.time)
+        self._data(message)
+
+    def ref(self, ref, mark):
+        """Write a plain ref"""
+        self.stream.write('reset %s\nfrom :%d\n\n' % (ref, mark))
+
+
+def create_repo(path, depth, files, patches, tags, changes):
+    """Create a bare repository of the given shape"""
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    importer = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path,
+                                stdin=subprocess.PIPE)
+    writer = FastImport(importer.stdin)
+
+    # Upstream history
+    src_files = ['src/file-%05d.txt' % num for num in range(files)]
+    upstream = [writer.commit('refs/heads/upstream', 'Initial version\n',
+                              [(fname, '%s\n' % fname) for
+                                    fname in src_files])]
+    for num in range(1, depth):
+        fname = src_files[num % files]
+        upstream.append(writer.commit('refs/heads/upstream',
+                                      'Upstream change %d\n' % num,
+                                      [(fname, 'upstream %d\n' % num)],
+                                      upstream[-1]))
+    writer.tag('upstream/1.0', upstream[-1], 'Upstream version 1.0\n')
+
+    # Packaging branch with patches on top of upstream
+    head = writer.commit('refs/heads/master', 'Add packaging\n',
+                         [('packaging/bench-package.spec', SPEC_TEMPLATE)],
+                         upstream[-1])
+    for num in range(patches):
+        fname = src_files[num % files]
+        head = writer.commit('refs/heads/master', 'Patch %d\n' % num,
+                             [(fname, 'patched %d\n' % num)], head)
+
+    # Tags and Gerrit-style change refs pointing to upstream history
+    for num in range(tags):
+        writer.ref('refs/tags/bench/%d' % num,
+                   upstream[num * len(upstream) // max(tags, 1)])
+    for num in range(changes):
+        writer.ref('refs/changes/%02d/%d/1' % (num % 100, num),
+                   upstream[num % len(upstream)])
+
+    importer.stdin.close()
+    if importer.wait():
+        raise Exception('git fast-import failed')
+    subprocess.check_call(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'],
+                          cwd=path)
+
+
+def run_service(url, workdir, cachedir, env):
+    """Run the service once, returns its metrics record"""
+    outdir = tempfile.mkdtemp(prefix='out-', dir=workdir)
+    metrics_fn = os.path.join(workdir, 'metrics.json')
+    if os.path.exists(metrics_fn):
+        os.unlink(metrics_fn)
+    os.environ.update(env)
+    os.environ['OBS_GBS_REPO_CACHE_DIR'] = cachedir
+    os.environ['OBS_GBS_METRICS_FILE'] = metrics_fn
+    try:
+        ret = service_main(['--url', url, '--outdir', outdir, '--config',
+                            os.path.join(workdir, 'bench.noconfig')])
+    finally:
+        shutil.rmtree(outdir)
+    if ret:
+        raise Exception('Service failed with exit code %d' % ret)
+    with open(metrics_fn) as metrics_fp:
+        return json.loads(metrics_fp.readline())
+
+
+def summarize(records):
+    """Median total and per-phase wall times of a list of metrics records"""
+    def median(values):
+        """Median of a list of numbers"""
+        values = sorted(values)
+        return values[len(values) // 2]
+    phases = {}
+    for record in records:
+        for phase in record['phases']:
+            phases.setdefault(phase['name'], []).append(phase['wall'])
+    return {'total': median([record['wall'] for record in records]),
+            'phases': dict((name, median(walls)) for
+                                name, walls in phases.items())}
+
+
+def run_scenario(name, shape, workdir, repeat, env):
+    """Benchmark one repository shape"""
+    repo_path = os.path.join(workdir, name + '.git')
+    sys.stderr.write('Generating %s repository: %s\n' % (name, shape))
+    start = time.time()
+    create_repo(repo_path, **shape)
+    sys.stderr.write('  generated in %.1fs\n' % (time.time() - start))
+    url = 'file://' + repo_path
+
+    results = {}
+    cold, warm = [], []
+    for _ in range(repeat):
+        cachedir = tempfile.mkdtemp(prefix='cache-', dir=workdir)
+        cold.append(run_service(url, workdir, cachedir, env))
+        warm.append(run_service(url, workdir, cachedir, env))
+        shutil.rmtree(cachedir)
+    results['cold'] = summarize(cold)
+    results['warm'] = summarize(warm)
+    return results
+
+
+def report(results, baseline, tolerance):
+    """Print results, returns the number of regressions found"""
+    regressions = 0
+    for scenario in sorted(results):
+        for cache in ('cold', 'warm'):
+            result = results[scenario][cache]
+            base = baseline.get(scenario, {}).get(cache)
+            line = '%-8s %-5s total %8.3fs' % (scenario, cache,
+                                               result['total'])
+            if base:
+                change = result['total'] / base['total'] - 1
+                line += ' (%+.0f%% vs. baseline)' % (change * 100)
+                if change > tolerance:
+                    line += ' REGRESSION'
+                    regressions += 1
+            print line
+            for phase, wall in sorted(result['phases'].items()):
+                base_wall = base['phases'].get(phase) if base else None
+                print '    %-22s %8.3fs%s' % (phase, wall,
+                        ' (baseline %.3fs)' % base_wall if base_wall else '')
+    return regressions
+
+
+def parse_args(argv):
+    """Argument parser"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS.keys()),
+                        help='Scenario to run, can be given multiple times, '
+                             'default is small and medium')
+    parser.add_argument('--depth', type=int,
+                        help='Override history depth of the scenarios')
+    parser.add_argument('--files', type=int,
+                        help='Override file count of the scenarios')
+    parser.add_argument('--patches', type=int,
+                        help='Override packaging patch count of the scenarios')
+    parser.add_argument('--tags', type=int,
+                        help='Override tag count of the scenarios')
+    parser.add_argument('--changes', type=int,
+                        help='Override refs/changes count of the scenarios')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of repetitions, default is %(default)s')
+    parser.add_argument('--set', metavar='KEY=VALUE', action='append',
+                        default=[],
+                        help='Set a service config option, e.g. '
+                             'export-mode=objects')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='Baseline file, default is %(default)s')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown relative to the baseline, '
+                             'default is %(default)s')
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't remove the working directory")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main function"""
+    args = parse_args(argv)
+    env = {}
+    for setting in args.set:
+        key, val = setting.split('=', 1)
+        env['OBS_GBS_%s' % key.replace('-', '_').upper()] = val
+
+    workdir = tempfile.mkdtemp(prefix='obs-service-gbs-bench_')
+    os.environ['GIT_CEILING_DIRECTORIES'] = workdir
+    results = {}
+    try:
+        for name in args.scenario or ['small', 'medium']:
+            shape = dict(SCENARIOS[name])
+            for key in shape:
+                if getattr(args, key) is not None:
+                    shape[key] = getattr(args, key)
+            results[name] = run_scenario(name, shape, workdir, args.repeat,
+                                         env)
+    finally:
+        if args.keep:
+            sys.stderr.write('Working directory kept in %s\n' % workdir)
+        else:
+            shutil.rmtree(workdir)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_fp:
+            baseline = json.load(baseline_fp)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_fp:
+            json.dump(baseline, baseline_fp, indent=4, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Startup time benchmark for the GBS source service
+
+Measures the cost of starting the service entry point in fresh Python
+interpreters: importing the service modules and answering --help. Also
+checks that the modules imported on demand by obs_service_gbs.command (GBS,
+git-buildpackage, repository cache) are not loaded at import time. The
+results can be compared against a stored baseline for catching startup
+regressions.
+
+Run from the top of the source tree:
+    $ python benchmarks/bench_import.py [--repeat N] [--save-baseline]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+TOPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__),
+                                'import_baseline.json')
+
+# Code run in a fresh interpreter for each scenario
+SCENARIOS = {
+    'interpreter': 'pass',
+    'client': 'import obs_service_gbs.client',
+    'command': 'import obs_service_gbs.command',
+    'help': 'import sys\n'
+            'from obs_service_gbs.client import main\n'
+            'sys.argv[1:] = ["--help"]\n'
+            'main()',
+    'preload': 'import obs_service_gbs.command as command\n'
+               'command.preload_modules()',
+}
+
+# Prints the lazily imported modules loaded by importing the command module
+EAGER_CHECK = """
+import sys
+import obs_service_gbs.command as command
+print ' '.join([name for name in command.LAZY_MODULES if name in sys.modules])
+"""
+
+
+def run_python(code):
+    """Run code in a fresh interpreter, returns its wall time and output"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([TOPDIR] +
+                                        env.get('PYTHONPATH', '').split(
+                                            os.pathsep))
+    # Don't forward --help to a running service daemon
+    env['OBS_GBS_DAEMON_SOCKET'] = ''
+    start = time.time()
+    popen = subprocess.Popen([sys.executable, '-c', code], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = popen.communicate()
+    wall = time.time() - start
+    if popen.returncode:
+        raise Exception('Python failed: %s' % stderr.strip())
+    return wall, stdout
+
+
+def run_scenarios(names, repeat):
+    """Median wall times of the scenarios"""
+    results = {}
+    for name in names:
+        walls = sorted([run_python(SCENARIOS[name])[0] for
+                            _ in range(repeat)])
+        results[name] = walls[len(walls) // 2]
+    return results
+
+
+def report(results, baseline, tolerance):
+    """Print results, returns the number of regressions found"""
+    regressions = 0
+    for name in sorted(results):
+        line = '%-12s %8.3fs' % (name, results[name])
+        if name != 'interpreter':
+            line += ' (%.3fs over interpreter startup)' % (
+                        results[name] - results.get('interpreter', 0))
+        if baseline.get(name):
+            change = results[name] / baseline[name] - 1
+            line += ' (%+.0f%% vs. baseline)' % (change * 100)
+            if change > tolerance:
+                line += ' REGRESSION'
+                regressions += 1
+        print line
+    return regressions
+
+
+def parse_args(argv):
+    """Argument parser"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append',
+                        choices=sorted(SCENARIOS.keys()),
+                        help='Scenario to run, can be given multiple times, '
+                             'default is all')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of repetitions, default is %(default)s')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='Baseline file, default is %(default)s')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown relative to the baseline, '
+                             'default is %(default)s')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main function"""
+    args = parse_args(argv)
+    names = args.scenario or sorted(SCENARIOS.keys())
+    if 'interpreter' not in names:
+        names.append('interpreter')
+    results = run_scenarios(names, max(args.repeat, 1))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_fp:
+            baseline = json.load(baseline_fp)
+    regressions = report(results, baseline, args.tolerance)
+    eager = run_python(EAGER_CHECK)[1].split()
+    if eager:
+        print 'REGRESSION: modules loaded at import time: %s' % \
+                ' '.join(eager)
+        regressions += 1
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_fp:
+            json.dump(baseline, baseline_fp, indent=4, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Batch mode of the GBS source service
+
+Jobs are read as JSON lines, one job per line, e.g.
+    {"url": "git://example.com/foo.git", "revision": "master",
+     "outdir": "foo", "options": {"git-meta": "_git_meta"}}
+
+Jobs are grouped by the repository URL and every group is run in a forked
+worker process, so that each repository is fetched only once per batch. One
+JSON result line is written to stdout for every job as soon as it finishes.
+"""
+
+import argparse
+import errno
+import json
+import os
+import select
+import sys
+import time
+
+import gbp.log as gbplog
+
+from obs_service_gbs import command
+from obs_service_gbs.command import (EXIT_OK, EXIT_ERR_SERVICE, LOGGER,
+                DEFAULT_CONFIGS, ServiceError, read_config, repo_cache_url,
+                start_worker_pool)
+from obs_service_gbs.metrics import PhaseTimer
+from obs_service_gbs.worker import stop_pool
+
+
+def check_job(job):
+    """Validate a job, returns an error message or None"""
+    if not isinstance(job, dict):
+        return 'not an object'
+    for key in ('url', 'outdir'):
+        if not job.get(key):
+            return "no '%s'" % key
+    if not isinstance(job.get('options', {}), dict):
+        return "'options' is not an object"
+    return None
+
+def read_jobs(job_fp):
+    """Read jobs from a file object, returns a list of (index, job, error)
+    tuples"""
+    jobs = []
+    for lineno, line in enumerate(job_fp, 1):
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            error = check_job(job)
+        except ValueError as err:
+            job, error = {}, err
+        if error:
+            error = 'Invalid job on line %d: %s' % (lineno, error)
+            job = job if isinstance(job, dict) else {}
+        jobs.append((len(jobs), job, error))
+    return jobs
+
+def group_jobs(jobs, config=None):
+    """Group valid jobs by repository, preserving the order of the jobs.
+    URLs are canonicalized according to config, if given."""
+    groups = []
+    by_url = {}
+    for index, job, error in jobs:
+        if error:
+            continue
+        url = repo_cache_url(config, job['url']) if config else job['url']
+        if url not in by_url:
+            by_url[url] = []
+            groups.append(by_url[url])
+        by_url[url].append((index, job))
+    return groups
+
+def job_argv(job, config_files):
+    """Service command line of a job"""
+    argv = ['--url', job['url'], '--outdir', os.path.abspath(job['outdir'])]
+    if job.get('revision'):
+        argv += ['--revision', job['revision']]
+    for key, val in sorted(job.get('options', {}).items()):
+        argv.append('--%s=%s' % (key, val))
+    for fname in config_files:
+        argv += ['--config', fname]
+    return [str(arg) for arg in argv]
+
+def job_result(index, job, exit_code, **fields):
+    """Result record of a job"""
+    result = {'index': index,
+              'id': job.get('id'),
+              'url': job.get('url'),
+              'revision': job.get('revision'),
+              'outdir': job.get('outdir'),
+              'exit_code': exit_code}
+    result.update(fields)
+    return result
+
+def run_job(index, job, config_files, fresh_since):
+    """Run the service for one job"""
+    timer = PhaseTimer()
+    try:
+        ret = command.main(job_argv(job, config_files), timer=timer,
+                           fresh_since=fresh_since)
+    except SystemExit as err:
+        # Invalid options
+        ret = err.code if isinstance(err.code, int) else EXIT_ERR_SERVICE
+    except Exception as err: # pylint: disable=W0703
+        LOGGER.error('Service crashed in batch job %d: %s', index, err)
+        ret = EXIT_ERR_SERVICE
+    record = timer.record()
+    return job_result(index, job, ret, wall=record['wall'],
+                      phases=record['phases'])
+
+def run_group(group, config_files, result_fd):
+    """Run a group of jobs of one repository, called in the forked worker"""
+    # The first job fetches the remote, the rest of the jobs reuse it
+    fresh_since = time.time()
+    with os.fdopen(result_fd, 'w') as result_fp:
+        for index, job in group:
+            result = run_job(index, job, config_files, fresh_since)
+            result_fp.write(json.dumps(result) + '\n')
+            result_fp.flush()
+
+
+class BatchRunner(object):
+    """Run job groups in a bounded number of forked worker processes"""
+
+    def __init__(self, config_files, workers, output=None, pool=None,
+                 config=None):
+        self.config_files = config_files
+        # Config used for grouping jobs of the same repository
+        self.config = config
+        self.workers = workers
+        self.output = output or sys.stdout
+        # Persistent GBS workers shared by all jobs
+        self.pool = pool
+        self.results = []
+        # Running workers: {pid: [result pipe, buffer, unfinished jobs]}
+        self.running = {}
+
+    def _emit(self, result):
+        """Write one result line"""
+        self.results.append(result)
+        self.output.write(json.dumps(result) + '\n')
+        self.output.flush()
+
+    def _start(self, group):
+        """Fork a worker for a group of jobs"""
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            ret = 0
+            try:
+                os.close(read_fd)
+                # Keep stdout clean for the results
+                sys.stdout.flush()
+                os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+                run_group(group, self.config_files, write_fd)
+            except: # pylint: disable=W0702
+                ret = 1
+            finally:
+                os._exit(ret)
+        os.close(write_fd)
+        self.running[pid] = [read_fd, '', dict(group)]
+
+    def _finish(self, pid):
+        """Collect an exited worker"""
+        read_fd, _buf, unfinished = self.running.pop(pid)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        for index, job in sorted(unfinished.items()):
+            self._emit(job_result(index, job, EXIT_ERR_SERVICE,
+                                  error='Batch worker died'))
+
+    def _read(self, pid):
+        """Read results from a worker"""
+        worker = self.running[pid]
+        try:
+            data = os.read(worker[0], 4096)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                return
+            raise
+        if not data:
+            self._finish(pid)
+            return
+        lines = (worker[1] + data).split('\n')
+        worker[1] = lines.pop()
+        for line in lines:
+            result = json.loads(line)
+            worker[2].pop(result['index'], None)
+            self._emit(result)
+
+    def run(self, jobs):
+        """Run all jobs, returns the list of results"""
+        for index, job, error in jobs:
+            if error:
+                LOGGER.error(error)
+                self._emit(job_result(index, job, EXIT_ERR_SERVICE,
+                                      error=error))
+        pending = group_jobs(jobs, self.config)
+        while pending or self.running:
+            if self.pool:
+                self.pool.maintain()
+            while pending and len(self.running) < self.workers:
+                self._start(pending.pop(0))
+            fds = dict((worker[0], pid) for pid, worker in
+                            self.running.items())
+            try:
+                readable = select.select(fds.keys(), [], [], 1.0)[0]
+            except select.error as err:
+                if err[0] == errno.EINTR:
+                    continue
+                raise
+            for read_fd in readable:
+                self._read(fds[read_fd])
+        return self.results
+
+
+def parse_args(argv):
+    """Argument parser"""
+    parser = argparse.ArgumentParser(
+                description='Export packaging files of many packages with the '
+                            'GBS source service')
+    parser.add_argument('jobs', nargs='?', default='-', metavar='JOBFILE',
+                        help='File containing the jobs as JSON lines, '
+                             'default is to read stdin')
+    parser.add_argument('--workers', '-j', type=int, default=4,
+                        help='Number of repositories processed in parallel, '
+                             'default is %(default)s')
+    parser.add_argument('--config', action='append',
+                        help='Config file to use, can be given multiple times')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Verbose output')
+    args = parser.parse_args(argv)
+    if not args.config:
+        args.config = DEFAULT_CONFIGS
+    return args
+
+def main(argv=None):
+    """Main function"""
+    args = parse_args(argv)
+    gbplog.setup(color='auto', verbose=args.verbose)
+    try:
+        if args.jobs == '-':
+            jobs = read_jobs(sys.stdin)
+        else:
+            with open(args.jobs) as job_fp:
+                jobs = read_jobs(job_fp)
+    except IOError as err:
+        LOGGER.error('Failed to read jobs: %s', err)
+        return EXIT_ERR_SERVICE
+
+    try:
+        config = read_config(args.config)
+        # Forked workers inherit the loaded modules
+        command.preload_modules()
+        pool = start_worker_pool(config)
+        try:
+            results = BatchRunner(args.config, max(args.workers, 1),
+                                  pool=pool, config=config).run(jobs)
+        finally:
+            stop_pool()
+    except ServiceError as err:
+        LOGGER.error(err[0])
+        return err[1]
+    failed = [result for result in results if result['exit_code'] != EXIT_OK]
+    LOGGER.info('Batch finished: %d jobs, %d failed', len(results),
+                len(failed))
+    return EXIT_ERR_SERVICE if failed else EXIT_OK
@@ -0,0 +1,147 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Index of the repository cache metadata"""
+
+import os
+import sqlite3
+
+import gbp.log as gbplog
+
+
+LOGGER = gbplog.getLogger('source_service')
+
+# Index database file, in the repository cache directory
+INDEX_FILE = '.index.sqlite'
+
+# Metadata of a cached repository, as in its state file
+COLUMNS = ('url', 'size', 'last_access', 'last_fetch', 'last_export')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (repodir TEXT PRIMARY KEY, url TEXT,
+    size INTEGER, last_access REAL, last_fetch REAL, last_export REAL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class CacheIndex(object):
+    """SQLite index of the repositories in the repository cache
+
+    The state files of the cached repositories are the authoritative source
+    of the metadata, the index only saves walking through the cache. The
+    index is considered complete only after it has been rebuilt from the
+    state files once, until then readers fall back to walking the cache.
+    Index errors are never fatal: they are logged and the index is simply
+    bypassed.
+    """
+
+    def __init__(self, base_dir):
+        self.path = os.path.join(os.path.abspath(base_dir), INDEX_FILE)
+        self.conn = None
+
+    def _connect(self):
+        """Open the index database, creating it if needed"""
+        if self.conn is None:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            # Concurrent service runs wait for each other's transactions
+            self.conn = sqlite3.connect(self.path, timeout=30)
+            self.conn.text_factory = str
+            self.conn.executescript(SCHEMA)
+        return self.conn
+
+    def close(self):
+        """Close the index database"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def update(self, repodir, state):
+        """Add or update the metadata of a cached repository"""
+        fields = [(col, state[col]) for col in COLUMNS if col in state]
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO repos (repodir) '
+                             'VALUES (?)', (repodir,))
+                if fields:
+                    conn.execute('UPDATE repos SET %s WHERE repodir = ?' %
+                                 ', '.join(['%s = ?' % col for col, _val in
+                                                fields]),
+                                 [val for _col, val in fields] + [repodir])
+        except (sqlite3.Error, OSError) as err:
+            LOGGER.warning('Failed to update repo cache index: %s', err)
+
+    def remove(self, repodir):
+        """Remove a cached repository from the index"""
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM repos WHERE repodir = ?',
+                             (repodir,))
+        except (sqlite3.Error, OSError) as err:
+            LOGGER.warning('Failed to update repo cache index: %s', err)
+
+    def entries(self):
+        """Get the metadata of all indexed repositories as a dict of
+        repodir: state, None if the index is not available"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            conn = self._connect()
+            if not conn.execute("SELECT value FROM meta WHERE "
+                                "key = 'complete'").fetchone():
+                return None
+            rows = conn.execute('SELECT repodir, %s FROM repos' %
+                                ', '.join(COLUMNS)).fetchall()
+        except (sqlite3.Error, OSError) as err:
+            LOGGER.warning('Failed to read repo cache index: %s', err)
+            return None
+        entries = {}
+        for row in rows:
+            entries[row[0]] = dict((col, val) for col, val in
+                                        zip(COLUMNS, row[1:]) if
+                                        val is not None)
+        return entries
+
+    def rebuild(self, entries):
+        """Replace the index contents, entries is a dict of repodir:
+        state. Export times are only recorded in the index, so they are
+        preserved."""
+        try:
+            conn = self._connect()
+            with conn:
+                exported = dict(conn.execute('SELECT repodir, last_export '
+                                             'FROM repos').fetchall())
+                for repodir, state in entries.items():
+                    if state.get('last_export') is None and \
+                            exported.get(repodir) is not None:
+                        state['last_export'] = exported[repodir]
+                conn.execute('DELETE FROM repos')
+                conn.executemany('INSERT INTO repos (repodir, %s) VALUES '
+                                 '(?, %s)' % (', '.join(COLUMNS),
+                                              ', '.join('?' * len(COLUMNS))),
+                                 [[repodir] + [state.get(col) for col in
+                                                   COLUMNS] for
+                                     repodir, state in entries.items()])
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) "
+                             "VALUES ('complete', '1')")
+        except (sqlite3.Error, OSError) as err:
+            LOGGER.warning('Failed to rebuild repo cache index: %s', err)
+            return False
+        return True
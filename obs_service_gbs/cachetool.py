@@ -0,0 +1,295 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Maintenance tool for the repository cache of the GBS source service"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import gbp.log as gbplog
+from gbp_repocache import CachedRepoError
+from obs_service_gbp_utils import str_to_bool
+
+from obs_service_gbs.cacheindex import CacheIndex
+from obs_service_gbs.command import (DEFAULT_CONFIGS, EXIT_OK,
+                EXIT_ERR_SERVICE, LOGGER, ServiceError, config_int,
+                get_repo_family, read_config, repo_cache_url,
+                update_cache_index)
+from obs_service_gbs.repocache import (ServiceCachedRepo, evict_repos,
+                is_sharded, iter_cached_repos, migrate_repo, read_repo_state,
+                scan_repos, sharded_path)
+
+
+def _format_time(timestamp):
+    """Format a timestamp for listings"""
+    if timestamp is None:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+def cached_repos(config):
+    """Get the metadata of the cached repositories from the cache index,
+    rebuilding the index if it is not available"""
+    index = CacheIndex(config['repo-cache-dir'])
+    repos = index.entries()
+    if repos is None:
+        repos = scan_repos(config['repo-cache-dir'])
+        index.rebuild(repos)
+    index.close()
+    return repos
+
+def cmd_list(args, config):
+    """List cached repositories"""
+    repos = cached_repos(config)
+    for repodir in sorted(repos):
+        state = repos[repodir]
+        size = state.get('size')
+        print '%-10s %-19s %-19s %-19s %s' % (
+                '%dM' % (size / 1024**2) if size is not None else '-',
+                _format_time(state.get('last_access')),
+                _format_time(state.get('last_fetch')),
+                _format_time(state.get('last_export')),
+                state.get('url', repodir))
+    return EXIT_OK
+
+def cmd_reindex(args, config):
+    """Rebuild the cache index by walking through the repository cache"""
+    index = CacheIndex(config['repo-cache-dir'])
+    repos = scan_repos(config['repo-cache-dir'])
+    ret = EXIT_OK if index.rebuild(repos) else EXIT_ERR_SERVICE
+    index.close()
+    LOGGER.info('Indexed %d repositories', len(repos))
+    return ret
+
+def cmd_evict(args, config):
+    """Evict repositories exceeding the cache size limits"""
+    if args.high_watermark is None:
+        args.high_watermark = config_int(config, 'repo-cache-high-watermark')
+    if args.low_watermark is None:
+        args.low_watermark = config_int(config, 'repo-cache-low-watermark')
+    if not args.high_watermark:
+        LOGGER.error('No high watermark configured')
+        return EXIT_ERR_SERVICE
+    index = CacheIndex(config['repo-cache-dir'])
+    evicted = evict_repos(config['repo-cache-dir'],
+                          args.high_watermark * 1024**2,
+                          (args.low_watermark or args.high_watermark) *
+                          1024**2, index)
+    index.close()
+    LOGGER.info('Evicted %d repositories', len(evicted))
+    return EXIT_OK
+
+def cmd_migrate(args, config):
+    """Move repositories of the flat layout into the sharded layout"""
+    if config['repo-cache-layout'] != 'sharded':
+        # Service runs would keep on cloning into the flat layout
+        LOGGER.error("Set 'repo-cache-layout = sharded' in the config before "
+                     "migrating")
+        return EXIT_ERR_SERVICE
+    base_dir = config['repo-cache-dir']
+    index = CacheIndex(base_dir)
+    migrated = skipped = 0
+    for repodir in list(iter_cached_repos(base_dir)):
+        if is_sharded(base_dir, repodir):
+            continue
+        new_repodir = sharded_path(base_dir, repodir)
+        if migrate_repo(repodir, new_repodir):
+            index.remove(repodir)
+            index.update(new_repodir, read_repo_state(new_repodir))
+            migrated += 1
+        else:
+            LOGGER.info('Skipped %s, repository in use', repodir)
+            skipped += 1
+    index.close()
+    LOGGER.info('Migrated %d repositories, %d skipped', migrated, skipped)
+    return EXIT_ERR_SERVICE if skipped else EXIT_OK
+
+def service_file_urls(path):
+    """Get the repository URLs of the GBS services in a _service file"""
+    try:
+        root = ET.parse(path).getroot()
+    except (IOError, ET.ParseError) as err:
+        raise ServiceError('Failed to parse %s: %s' % (path, err),
+                           EXIT_ERR_SERVICE)
+    urls = []
+    for service in root.findall('service'):
+        if service.get('name') != 'gbs':
+            continue
+        for param in service.findall('param'):
+            if param.get('name') == 'url' and param.text:
+                urls.append(param.text.strip())
+    return urls
+
+def prewarm_urls(sources):
+    """Get the list of URLs to pre-warm, sources are URLs or _service
+    files"""
+    urls = []
+    for source in sources:
+        if os.path.isfile(source):
+            new_urls = service_file_urls(source)
+        else:
+            new_urls = [source]
+        urls.extend([url for url in new_urls if url not in urls])
+    return urls
+
+def prewarm_repo(url, config):
+    """Clone or fetch one repository, returns (url, error, wall time)"""
+    start = time.time()
+    error = None
+    try:
+        cache_url = repo_cache_url(config, url)
+        repo = ServiceCachedRepo(config['repo-cache-dir'], url,
+                    bare=config['export-mode'] != 'checkout',
+                    refs_hack=str_to_bool(config['repo-cache-refs-hack']),
+                    revision='HEAD',
+                    fetch_ttl=config_int(config, 'repo-cache-fetch-ttl'),
+                    ls_remote=str_to_bool(config['repo-cache-ls-remote']),
+                    depth=config_int(config, 'repo-cache-clone-depth'),
+                    clone_filter=config['repo-cache-clone-filter'],
+                    cache_url=cache_url,
+                    family=get_repo_family(config, cache_url),
+                    layout=config['repo-cache-layout'],
+                    fetch_timeout=config_int(config,
+                                             'repo-cache-fetch-timeout'))
+        update_cache_index(config, repo)
+        repo.close()
+    except (CachedRepoError, ServiceError) as err:
+        error = str(err)
+    return url, error, time.time() - start
+
+def _prewarm_worker(job):
+    """Pool worker function for prewarm"""
+    return prewarm_repo(*job)
+
+def cmd_prewarm(args, config):
+    """Clone or fetch repositories into the cache"""
+    sources = list(args.sources)
+    for fname in args.from_file or []:
+        try:
+            with (sys.stdin if fname == '-' else open(fname)) as list_fp:
+                sources.extend([line.strip() for line in list_fp if
+                                    line.strip() and not
+                                    line.startswith('#')])
+        except IOError as err:
+            raise ServiceError('Failed to read %s: %s' % (fname, err),
+                               EXIT_ERR_SERVICE)
+    # Aliases of the same repository need to be fetched only once
+    urls = []
+    cache_urls = set()
+    for url in prewarm_urls(sources):
+        if repo_cache_url(config, url) not in cache_urls:
+            cache_urls.add(repo_cache_url(config, url))
+            urls.append(url)
+    if not urls:
+        LOGGER.error('No repositories to pre-warm')
+        return EXIT_ERR_SERVICE
+
+    LOGGER.info('Pre-warming %d repositories with %d parallel jobs',
+                len(urls), args.jobs)
+    start = time.time()
+    pool = multiprocessing.Pool(min(max(args.jobs, 1), len(urls)))
+    results = []
+    try:
+        for url, error, wall in pool.imap_unordered(_prewarm_worker,
+                                    [(url, config) for url in urls]):
+            results.append((url, error, wall))
+            if error:
+                LOGGER.error('[%d/%d] %s failed after %.1fs: %s',
+                             len(results), len(urls), url, wall, error)
+            else:
+                LOGGER.info('[%d/%d] %s done in %.1fs', len(results),
+                            len(urls), url, wall)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [result for result in results if result[1]]
+    print '%-8s %-6s %s' % ('TIME', 'STATUS', 'URL')
+    for url, error, wall in sorted(results, key=lambda res: -res[2]):
+        print '%-8s %-6s %s' % ('%.1fs' % wall, 'FAILED' if error else 'OK',
+                                url)
+    print 'Pre-warmed %d of %d repositories in %.1fs' % (
+            len(results) - len(failed), len(urls), time.time() - start)
+    return EXIT_ERR_SERVICE if failed else EXIT_OK
+
+def parse_args(argv):
+    """Argument parser"""
+    parser = argparse.ArgumentParser(
+                description='Maintain the repository cache of the GBS source '
+                            'service')
+    parser.add_argument('--config', action='append',
+                        help='Config file to use, can be given multiple times')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Verbose output')
+    subparsers = parser.add_subparsers()
+
+    list_parser = subparsers.add_parser('list',
+                                        help='List cached repositories')
+    list_parser.set_defaults(func=cmd_list)
+
+    evict_parser = subparsers.add_parser('evict',
+                        help='Evict least recently used repositories')
+    evict_parser.add_argument('--high-watermark', type=int, metavar='MB',
+                        help='Evict only if the cache is bigger than this, '
+                             'overrides config')
+    evict_parser.add_argument('--low-watermark', type=int, metavar='MB',
+                        help='Evict until the cache is smaller than this, '
+                             'overrides config')
+    evict_parser.set_defaults(func=cmd_evict)
+
+    reindex_parser = subparsers.add_parser('reindex',
+                        help='Rebuild the cache index from the repositories')
+    reindex_parser.set_defaults(func=cmd_reindex)
+
+    migrate_parser = subparsers.add_parser('migrate',
+                        help='Move repositories into the sharded layout')
+    migrate_parser.set_defaults(func=cmd_migrate)
+
+    prewarm_parser = subparsers.add_parser('prewarm',
+                        help='Clone or fetch repositories into the cache')
+    prewarm_parser.add_argument('sources', nargs='*', metavar='URL|SERVICE',
+                        help='Repository URL or _service file containing '
+                             'GBS services')
+    prewarm_parser.add_argument('--from-file', '-f', action='append',
+                        metavar='FILE',
+                        help='Read URLs or _service file paths from FILE, '
+                             'one per line, - for stdin')
+    prewarm_parser.add_argument('--jobs', '-j', type=int, default=4,
+                        help='Number of repositories processed in parallel, '
+                             'default is %(default)s')
+    prewarm_parser.set_defaults(func=cmd_prewarm)
+
+    args = parser.parse_args(argv)
+    if not args.config:
+        args.config = DEFAULT_CONFIGS
+    return args
+
+def main(argv=None):
+    """Main function"""
+    args = parse_args(argv)
+    gbplog.setup(color='auto', verbose=args.verbose)
+    if args.verbose:
+        LOGGER.setLevel(gbplog.DEBUG)
+    try:
+        return args.func(args, read_config(args.config))
+    except ServiceError as err:
+        LOGGER.error(err[0])
+        return err[1]
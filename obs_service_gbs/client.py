@@ -0,0 +1,115 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Thin client forwarding service runs to the GBS service daemon
+
+This module is imported by the service entry point on every run, so it must
+not import GBS, git-buildpackage or anything else that is expensive to load.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+
+
+# Default location of the daemon socket
+DEFAULT_SOCKET = '/var/run/obs/gbs-service.sock'
+
+# Environment variable for overriding the socket path, empty value disables
+# the daemon
+SOCKET_ENVVAR = 'OBS_GBS_DAEMON_SOCKET'
+
+# Prefix of the environment variables forwarded to the daemon
+ENV_PREFIX = 'OBS_GBS_'
+
+# Marker separating service output from the exit code in the daemon reply
+EXIT_MARKER = '\0'
+
+# Same as obs_service_gbs.command.EXIT_ERR_SERVICE
+EXIT_ERR_SERVICE = 1
+
+
+def socket_path():
+    """Get the path of the daemon socket, None if the daemon is disabled"""
+    return os.environ.get(SOCKET_ENVVAR, DEFAULT_SOCKET) or None
+
+def encode_request(argv):
+    """Create a daemon request for running the service with argv"""
+    env = dict((key, val) for key, val in os.environ.items() if
+                    key.startswith(ENV_PREFIX))
+    request = {'argv': argv,
+               'prog': os.path.basename(sys.argv[0]),
+               'cwd': os.getcwd(),
+               'env': env}
+    return json.dumps(request) + '\n'
+
+def connect(path):
+    """Connect to the daemon, returns None if the daemon is not running"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as err:
+        sock.close()
+        if err.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.EACCES):
+            return None
+        raise
+    return sock
+
+def forward(sock, argv, output=None):
+    """Run the service in the daemon and relay its output"""
+    output = output or sys.stdout
+    sock.sendall(encode_request(argv))
+    status = None
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        if status is not None:
+            status += data
+        elif EXIT_MARKER in data:
+            data, status = data.split(EXIT_MARKER, 1)
+            output.write(data)
+        else:
+            output.write(data)
+    output.flush()
+    sock.close()
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        sys.stderr.write('ERROR: GBS service daemon died unexpectedly\n')
+        return EXIT_ERR_SERVICE
+
+def main(argv=None):
+    """Main function: use the daemon if it is running, otherwise run the
+    service in this process"""
+    argv = sys.argv[1:] if argv is None else argv
+    path = socket_path()
+    sock = None
+    if path:
+        try:
+            sock = connect(path)
+        except socket.error as err:
+            sys.stderr.write('WARNING: failed to connect to GBS service '
+                             'daemon: %s\n' % err)
+    if sock:
+        return forward(sock, argv)
+
+    from obs_service_gbs.command import main as service_main
+    return service_main(argv)
@@ -16,30 +16,64 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
-"""The GBS source service for OBS"""
+"""The GBS source service for OBS
+
+GBS, git-buildpackage and the repository cache modules are expensive to
+import. They are imported only when the service phase needing them runs, so
+that e.g. --help and argument errors are answered quickly.
+"""
 
 import argparse
+import cProfile
+import fcntl
+import hashlib
+import json
 import os
+import re
 import shutil
 import tempfile
-from ConfigParser import SafeConfigParser
+import time
+from ConfigParser import NoOptionError, SafeConfigParser
 
-from gitbuildsys.cmd_export import main as cmd_export
-from gitbuildsys import log as gbs_log
-from gitbuildsys.errors import CmdError
 import gbp.log as gbplog
 
-import gbp_repocache
-from gbp_repocache import CachedRepo, CachedRepoError
-from obs_service_gbp_utils import (GbpServiceError, GbpChildBTError, fork_call,
-                sanitize_uid_gid, write_treeish_meta, str_to_bool)
+from obs_service_gbs.exportcache import ExportCache
+from obs_service_gbs.metrics import PhaseTimer
+from obs_service_gbs.utils import (ChildCallError, DeadlineExceeded,
+                call_with_deadline)
+from obs_service_gbs.worker import WorkerJobError, get_pool, start_pool
+
+
+# Ways of providing GBS with a git repository to export from
+EXPORT_MODES = ('checkout', 'objects', 'worktree')
+
+# Directory layouts of the repository cache
+REPO_CACHE_LAYOUTS = ('flat', 'sharded')
+
+# Default config files
+DEFAULT_CONFIGS = ['/etc/obs/services/gbs', '~/.obs/gbs']
 
+# Minimum interval between repository cache size checks, in seconds
+EVICTION_INTERVAL = 300
+
+# Lifetime of exports shared with concurrent identical service runs when the
+# export cache is disabled, in seconds
+SHARED_EXPORT_TTL = 60
+
+# State file of the skip-unchanged mode, written into the output directory
+EXPORT_STATE_FILE = '.gbs-export-state'
+
+# Modules imported on demand, see preload_modules()
+LAZY_MODULES = ('gitbuildsys.cmd_export', 'gitbuildsys.errors',
+                'gitbuildsys.log', 'gbp_repocache', 'obs_service_gbp_utils',
+                'obs_service_gbs.cacheindex', 'obs_service_gbs.repocache')
 
 # Exit codes
 EXIT_OK = 0
 EXIT_ERR_SERVICE = 1
 EXIT_ERR_GBS_EXPORT = 2
 EXIT_ERR_GBS_CRASH = 3
+EXIT_ERR_TIMEOUT = 4
 
 # Template spec file for the "error package"
 ERROR_PKG_SPEC = """
@@ -81,6 +115,22 @@ class ServiceError(Exception):
     """Source service errors"""
     pass
 
+def preload_modules():
+    """Import all modules needed by service runs, in long-running processes
+    forking the service runs"""
+    for name in LAZY_MODULES:
+        __import__(name)
+
+def cmd_export(gbs_args):
+    """Run the GBS export command"""
+    from gitbuildsys.cmd_export import main as gbs_cmd_export
+    return gbs_cmd_export(gbs_args)
+
+def fork_call(uid, gid, func):
+    """Wrapper of obs_service_gbp_utils.fork_call()"""
+    from obs_service_gbp_utils import fork_call as gbp_fork_call
+    return gbp_fork_call(uid, gid, func)
+
 def construct_gbs_args(args, outdir, gitdir):
     """Construct args list for GBS"""
     # Replicate gbs export command line arguments
@@ -100,12 +150,58 @@ def construct_gbs_args(args, outdir, gitdir):
         gbs_args['commit'] = args.revision
     return argparse.Namespace(**gbs_args)
 
+def read_families(parser):
+    '''Read repository families from '[family NAME]' config sections'''
+    families = []
+    for section in parser.sections():
+        if not section.startswith('family '):
+            continue
+        name = section[len('family '):].strip()
+        if not re.match(r'^[\w.-]+$', name):
+            raise ServiceError("Invalid repository family name '%s'" % name,
+                               EXIT_ERR_SERVICE)
+        try:
+            url = parser.get(section, 'base', raw=True).strip()
+            members = parser.get(section, 'members', raw=True)
+        except NoOptionError as err:
+            raise ServiceError(str(err), EXIT_ERR_SERVICE)
+        families.append((name, url, re.split(r'[\s,]+', members.strip())))
+    return families
+
 def read_config(filenames):
-    '''Read configuration file(s)'''
+    '''Read configuration file(s), repository families are stored in the
+    'repo-families' key'''
     defaults = {'repo-cache-dir': '/var/cache/obs/gbs-repos/',
                 'gbs-user': None,
                 'gbs-group': None,
-                'repo-cache-refs-hack': 'no'}
+                'gbs-workers': '0',
+                'gbs-worker-max-jobs': '100',
+                'gbs-worker-max-rss': '512',
+                'repo-cache-refs-hack': 'no',
+                'repo-cache-fetch-ttl': '0',
+                'repo-cache-ls-remote': 'no',
+                'repo-cache-swr': '0',
+                'repo-cache-fetch-timeout': '0',
+                'repo-cache-offline-fallback': 'no',
+                'repo-cache-swr-refreshes': '2',
+                'repo-cache-clone-depth': '0',
+                'repo-cache-clone-filter': '',
+                'repo-cache-high-watermark': '0',
+                'repo-cache-low-watermark': '0',
+                'repo-cache-layout': 'flat',
+                'repo-cache-url-aliases': '',
+                'repo-cache-url-strip-user': 'no',
+                'repo-cache-url-strip-git-suffix': 'no',
+                'fetch-deadline': '0',
+                'checkout-deadline': '0',
+                'export-deadline': '0',
+                'export-mode': 'checkout',
+                'export-cache-dir': '',
+                'export-cache-max-size': '1024',
+                'export-cache-max-age': '30',
+                'metrics-file': '',
+                'profile-dir': '',
+                'skip-unchanged': 'no'}
 
     filenames = [os.path.expanduser(fname) for fname in filenames]
     LOGGER.debug('Trying %s config files: %s', len(filenames), filenames)
@@ -123,11 +219,201 @@ def read_config(filenames):
         if envvar in os.environ:
             parser.set('general', key, os.environ[envvar])
 
-    # We only use keys from one section, for now
-    return dict(parser.items('general'))
+    # Only repository families have sections of their own
+    config = dict(parser.items('general'))
+    config['repo-families'] = read_families(parser)
+    return config
+
+def config_int(config, key):
+    '''Get an integer config value'''
+    try:
+        return int(config[key])
+    except ValueError:
+        raise ServiceError("Invalid value for '%s': %s" % (key, config[key]),
+                           EXIT_ERR_SERVICE)
+
+def repo_cache_url(config, url):
+    '''Canonical URL of a repository in the repository cache'''
+    from obs_service_gbp_utils import str_to_bool
+    from obs_service_gbs.repocache import canonical_url
+    aliases = []
+    for rule in re.split(r'[,\n]', config['repo-cache-url-aliases']):
+        if not rule.strip():
+            continue
+        fields = rule.split()
+        if len(fields) != 2:
+            raise ServiceError("Invalid URL alias '%s', must be 'ALIAS "
+                               "CANONICAL'" % rule.strip(), EXIT_ERR_SERVICE)
+        aliases.append(fields)
+    return canonical_url(url, aliases,
+                strip_user=str_to_bool(config['repo-cache-url-strip-user']),
+                strip_suffix=str_to_bool(
+                                config['repo-cache-url-strip-git-suffix']))
+
+def get_repo_family(config, url):
+    '''Get the family of a repository, None if it does not belong to one'''
+    from obs_service_gbs.repocache import RepoFamily
+    for name, base_url, members in config['repo-families']:
+        family = RepoFamily(config['repo-cache-dir'], name, base_url, members)
+        if family.matches(url):
+            return family
+    return None
+
+def get_export_cache(config):
+    '''Get export cache, None if not enabled'''
+    if not config['export-cache-dir']:
+        return None
+    return ExportCache(config['export-cache-dir'],
+                max_size=config_int(config, 'export-cache-max-size') * 1024**2,
+                max_age=config_int(config, 'export-cache-max-age') * 86400,
+                evict_interval=EVICTION_INTERVAL)
+
+def evict_repo_cache(config):
+    '''Keep the repository cache within its configured size limits'''
+    from obs_service_gbs.cacheindex import CacheIndex
+    from obs_service_gbs.repocache import evict_repos
+    high_watermark = config_int(config, 'repo-cache-high-watermark') * 1024**2
+    if not high_watermark:
+        return
+    low_watermark = config_int(config, 'repo-cache-low-watermark') * 1024**2
+    # Checking the size of the cache is expensive, don't do it on every run
+    stamp = os.path.join(config['repo-cache-dir'], '.last-eviction')
+    try:
+        if time.time() - os.path.getmtime(stamp) < EVICTION_INTERVAL:
+            return
+    except OSError:
+        pass
+    try:
+        open(stamp, 'w').close()
+    except IOError as err:
+        LOGGER.warning('Failed to update eviction timestamp: %s', err)
+    index = CacheIndex(config['repo-cache-dir'])
+    evict_repos(config['repo-cache-dir'], high_watermark,
+                low_watermark or high_watermark, index)
+    index.close()
+
+def update_cache_index(config, repo, **kwargs):
+    '''Record the metadata of a cached repository in the cache index'''
+    from obs_service_gbs.cacheindex import CacheIndex
+    state = repo.read_state()
+    if not repo.fetched:
+        # Keep the size computed by the last eviction
+        state.pop('size', None)
+    state.update(kwargs)
+    index = CacheIndex(config['repo-cache-dir'])
+    index.update(repo.repodir, state)
+    index.close()
+
+def chown_tree(path, uid, gid):
+    '''Change the owner of a directory tree'''
+    if (uid, gid) == (os.getuid(), os.getgid()):
+        return
+    os.lchown(path, uid, gid)
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in dirnames + filenames:
+            os.lchown(os.path.join(dirpath, fname), uid, gid)
+
+def prepare_export_dirs(repo, args, config, tmpdir, uid, gid):
+    '''Prepare git repository and output directory for GBS'''
+    from gbp_repocache import CachedRepoError
 
-def gbs_export(repo, args, config):
+    try:
+        if config['export-mode'] == 'checkout':
+            gitdir = repo.repodir
+        elif config['export-mode'] == 'objects':
+            # Export from a private repository borrowing objects from the
+            # cache, leaving the cached repository untouched
+            gitdir = os.path.join(tmpdir, 'git')
+            repo.materialize(args.revision, gitdir)
+        else:
+            # Export from a worktree of its own, sharing the object store
+            # with other exports of the same repository
+            gitdir = os.path.join(tmpdir, os.path.basename(tmpdir))
+            chown_tree(repo.add_worktree(args.revision, gitdir), uid, gid)
+    except CachedRepoError as err:
+        raise ServiceError('RepoCache: %s' % err, EXIT_ERR_SERVICE)
+    if gitdir != repo.repodir:
+        chown_tree(gitdir, uid, gid)
+    outdir = os.path.join(tmpdir, 'export')
+    os.mkdir(outdir)
+    os.chown(outdir, uid, gid)
+    return gitdir, outdir
+
+def profile_basename(args):
+    '''Base name of profile files, tagged with the URL and the revision'''
+    url = re.sub(r'[^A-Za-z0-9._-]+', '_', args.url).strip('_')
+    return '%s-%s' % (url, args.revision)
+
+def profiled(func, filename):
+    '''Wrap a function so that it's run under the profiler'''
+    def _profiled_func(*args, **kwargs):
+        '''Run func and write profile data into filename'''
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            profiler.dump_stats(filename)
+    return _profiled_func
+
+def save_profile(profile, args, suffix):
+    '''Write profile data into the profile directory, profile is either a
+    profiler or a file containing profile data'''
+    filename = os.path.join(args.profile, '%s-%s.prof' %
+                            (profile_basename(args), suffix))
+    try:
+        if not os.path.isdir(args.profile):
+            os.makedirs(args.profile)
+        if isinstance(profile, cProfile.Profile):
+            profile.dump_stats(filename)
+        else:
+            shutil.move(profile, filename)
+    except (IOError, OSError) as err:
+        LOGGER.warning('Failed to write profile: %s', err)
+        return
+    LOGGER.info('Profile written to %s', filename)
+
+def pool_export(gbs_args):
+    '''Export function run by the GBS workers'''
+    # Look up cmd_export at call time, so that it can be replaced
+    return cmd_export(gbs_args)
+
+def start_worker_pool(config):
+    '''Start persistent GBS workers, if enabled in config'''
+    size = config_int(config, 'gbs-workers')
+    if not size:
+        return None
+    from obs_service_gbp_utils import GbpServiceError, sanitize_uid_gid
+    try:
+        uid, gid = sanitize_uid_gid(config['gbs-user'], config['gbs-group'])
+    except GbpServiceError as err:
+        raise ServiceError(err, EXIT_ERR_SERVICE)
+    return start_pool(pool_export, size, uid, gid,
+                max_jobs=config_int(config, 'gbs-worker-max-jobs'),
+                max_rss=config_int(config, 'gbs-worker-max-rss') * 1024**2)
+
+def run_export(uid, gid, gbs_args, profile_fn=None, timeout=0):
+    '''Run GBS export as the given user, in a persistent worker if one is
+    available. GBS and its subprocesses are killed if the export does not
+    finish in timeout seconds.'''
+    pool = get_pool()
+    if pool and (pool.uid, pool.gid) == (uid, gid) and not profile_fn:
+        pool.call(gbs_args, timeout=timeout)
+    elif profile_fn:
+        call_with_deadline(timeout, fork_call(uid, gid, profiled(cmd_export,
+                                                                 profile_fn)),
+                           gbs_args)
+    else:
+        call_with_deadline(timeout, fork_call(uid, gid, cmd_export), gbs_args)
+
+def gbs_export(repo, args, config, timer=None):
     '''Export packaging files with GBS'''
+    from gitbuildsys import log as gbs_log
+    from gitbuildsys.errors import CmdError
+    from obs_service_gbp_utils import (GbpChildBTError, GbpServiceError,
+                sanitize_uid_gid)
+
+    timer = timer or PhaseTimer()
+    gbs_log.setup(verbose=args.verbose == 'yes')
     # Create temporary directory
     try:
         tmpdir = tempfile.mkdtemp(dir=args.outdir)
@@ -143,12 +429,29 @@ def gbs_export(repo, args, config):
     os.chown(tmpdir, uid, gid)
 
     # Do export
+    child_profile = None
     try:
-        gbs_args = construct_gbs_args(args, tmpdir, repo.repodir)
+        with timer.phase('export-prepare'):
+            gitdir, outdir = prepare_export_dirs(repo, args, config, tmpdir,
+                                                 uid, gid)
+        gbs_args = construct_gbs_args(args, outdir, gitdir)
         LOGGER.info('Exporting packaging files with GBS')
         LOGGER.debug('gbs args: %s', gbs_args)
+        if args.profile:
+            # The child runs as the GBS user, let it write its profile into
+            # the tmpdir owned by that user
+            child_profile = os.path.join(tmpdir, 'gbs.prof')
         try:
-            fork_call(uid, gid, cmd_export)(gbs_args)
+            with timer.phase('export'):
+                run_export(uid, gid, gbs_args, child_profile,
+                           config_int(config, 'export-deadline'))
+        except DeadlineExceeded as err:
+            raise ServiceError('GBS export killed: %s' % err,
+                               EXIT_ERR_TIMEOUT)
+        except ChildCallError as err:
+            LOGGER.error('GBS process died: %s', err)
+            raise ServiceError('GBS crashed, export failed',
+                               EXIT_ERR_GBS_CRASH)
         except GbpServiceError as err:
             LOGGER.error('Internal service error when trying to run GBS: '
                          '%s', err)
@@ -157,7 +460,7 @@ def gbs_export(repo, args, config):
                                EXIT_ERR_SERVICE)
         except GbpChildBTError as err:
             # CmdError and its sublasses are exptected errors
-            if issubclass(err.typ, CmdError):
+            if isinstance(err.typ, type) and issubclass(err.typ, CmdError):
                 raise ServiceError('GBS export failed: %s' % err.val,
                                    EXIT_ERR_GBS_EXPORT)
             else:
@@ -165,15 +468,352 @@ def gbs_export(repo, args, config):
                              '%s', err.prettyprint_tb())
                 raise ServiceError('GBS crashed, export failed',
                                    EXIT_ERR_GBS_CRASH)
+        except WorkerJobError as err:
+            # Same classification as with errors of the forked child
+            if err.cmd_error:
+                raise ServiceError('GBS export failed: %s' % err,
+                                   EXIT_ERR_GBS_EXPORT)
+            else:
+                LOGGER.error('Uncaught exception in GBS:\n'
+                             '%s', err.traceback)
+                raise ServiceError('GBS crashed, export failed',
+                                   EXIT_ERR_GBS_CRASH)
 
         # Move packaging files from tmpdir to actual outdir
-        exportdir = os.path.join(tmpdir, os.listdir(tmpdir)[0])
-        for fname in os.listdir(exportdir):
-            shutil.move(os.path.join(exportdir, fname),
-                        os.path.join(args.outdir, fname))
+        with timer.phase('move'):
+            exportdir = os.path.join(outdir, os.listdir(outdir)[0])
+            fnames = os.listdir(exportdir)
+            for fname in fnames:
+                shutil.move(os.path.join(exportdir, fname),
+                            os.path.join(args.outdir, fname))
         LOGGER.info('Packaging files successfully exported')
     finally:
+        if child_profile and os.path.exists(child_profile):
+            save_profile(child_profile, args, 'gbs')
         shutil.rmtree(tmpdir)
+        if config['export-mode'] == 'worktree':
+            repo.remove_worktree(os.path.join(tmpdir,
+                                              os.path.basename(tmpdir)))
+    return fnames
+
+def check_config(args, config):
+    """Validate config and merge it with service parameters"""
+    if config['export-mode'] not in EXPORT_MODES:
+        raise ServiceError("Invalid export-mode '%s', must be one of %s" %
+                           (config['export-mode'], EXPORT_MODES),
+                           EXIT_ERR_SERVICE)
+    if config['repo-cache-layout'] not in REPO_CACHE_LAYOUTS:
+        raise ServiceError("Invalid repo-cache-layout '%s', must be one of %s"
+                           % (config['repo-cache-layout'], REPO_CACHE_LAYOUTS),
+                           EXIT_ERR_SERVICE)
+    # Service parameters override config for new clones
+    if args.clone_depth is None:
+        args.clone_depth = config_int(config, 'repo-cache-clone-depth')
+    if args.clone_filter is None:
+        args.clone_filter = config['repo-cache-clone-filter']
+    if args.profile is None and config['profile-dir']:
+        args.profile = os.path.abspath(config['profile-dir'])
+    if args.skip_unchanged is None:
+        args.skip_unchanged = config['skip-unchanged']
+    from obs_service_gbp_utils import str_to_bool
+    # Exported revision is only known from the git-meta file
+    args.skip_unchanged = str_to_bool(args.skip_unchanged) and \
+                          bool(args.git_meta)
+
+def update_repo_cache(args, config, timer, fresh_since=None):
+    """Create / update cached repository and resolve the revision to export"""
+    import gbp_repocache
+    from gbp_repocache import CachedRepoError
+    from obs_service_gbp_utils import str_to_bool
+    from obs_service_gbs.repocache import CachedRepoTimeout, ServiceCachedRepo
+
+    if args.verbose == 'yes':
+        gbp_repocache.LOGGER.setLevel(gbplog.DEBUG)
+    # Only the checkout mode needs a working copy in the cache
+    bare = config['export-mode'] != 'checkout'
+    refs_hack = str_to_bool(config['repo-cache-refs-hack'])
+    cache_url = repo_cache_url(config, args.url)
+    try:
+        with timer.phase('fetch'):
+            repo = ServiceCachedRepo(config['repo-cache-dir'], args.url,
+                    bare=bare, refs_hack=refs_hack, revision=args.revision,
+                    fetch_ttl=config_int(config, 'repo-cache-fetch-ttl'),
+                    ls_remote=str_to_bool(config['repo-cache-ls-remote']),
+                    depth=args.clone_depth, clone_filter=args.clone_filter,
+                    fresh_since=fresh_since, cache_url=cache_url,
+                    family=get_repo_family(config, cache_url),
+                    layout=config['repo-cache-layout'],
+                    swr_max_age=config_int(config, 'repo-cache-swr'),
+                    fetch_timeout=config_int(config,
+                                             'repo-cache-fetch-timeout'),
+                    offline_fallback=str_to_bool(
+                                    config['repo-cache-offline-fallback']),
+                    deadline=config_int(config, 'fetch-deadline'),
+                    shared=bare)
+        with timer.phase('checkout'):
+            timeout = config_int(config, 'checkout-deadline')
+            try:
+                if bare:
+                    args.revision = call_with_deadline(timeout, repo.resolve,
+                                                       args.revision)
+                else:
+                    args.revision = call_with_deadline(timeout,
+                                            repo.update_working_copy,
+                                            args.revision, submodules=False)
+            except DeadlineExceeded as err:
+                repo.remove_git_locks()
+                raise ServiceError('Checkout killed: %s' % err,
+                                   EXIT_ERR_TIMEOUT)
+            except ChildCallError as err:
+                repo.remove_git_locks()
+                raise ServiceError('Checkout failed: %s' % err,
+                                   EXIT_ERR_SERVICE)
+    except CachedRepoTimeout as err:
+        raise ServiceError('RepoCache: %s' % err, EXIT_ERR_TIMEOUT)
+    except CachedRepoError as err:
+        raise ServiceError('RepoCache: %s' % err, EXIT_ERR_SERVICE)
+    return repo
+
+def export_sources(repo, args, config, timer):
+    """Export sources with GBS, unless found in the export cache. Identical
+    concurrent exports wait for the first one and use its results."""
+    export_cache = get_export_cache(config)
+    if export_cache is None and config['export-mode'] == 'checkout':
+        # The exclusive repository lock is held until the end of the run, so
+        # identical runs cannot wait for each other's export
+        return run_gbs_export(repo, args, config, timer)
+    # Without the export cache, results are only handed over to the runs that
+    # waited for an identical export in progress
+    in_flight = export_cache is None
+    if in_flight:
+        export_cache = ExportCache(os.path.join(config['repo-cache-dir'],
+                                                '.exports'),
+                                   max_age=SHARED_EXPORT_TTL,
+                                   evict_interval=EVICTION_INTERVAL)
+    cache_key = export_cache.key(repo.cache_url, args.revision,
+                                 construct_gbs_args(args, None, None))
+    wait_start = time.time()
+    with export_cache.lock(cache_key, remove=in_flight) as waited:
+        if waited or not in_flight:
+            with timer.phase('export-cache-restore'):
+                fnames = export_cache.restore(cache_key, args.outdir,
+                                        wait_start if in_flight else None)
+                if fnames:
+                    LOGGER.info('Packaging files restored from export cache')
+                    return fnames
+        fnames = run_gbs_export(repo, args, config, timer)
+        if not in_flight or export_cache.has_waiters(cache_key):
+            with timer.phase('export-cache-store'):
+                export_cache.store(cache_key, args.outdir, fnames)
+                export_cache.evict()
+    return fnames
+
+def export_state(repo, args):
+    """Identifier of the exported revision and export parameters"""
+    return {'export': ExportCache.key(repo.cache_url, args.revision,
+                                      construct_gbs_args(args, None, None)),
+            'git-meta': args.git_meta}
+
+def is_plain_fname(fname):
+    """Check that a file name refers to a file directly in a directory"""
+    return isinstance(fname, basestring) and fname not in ('', '.', '..') \
+            and os.sep not in fname
+
+def read_export_state(outdir):
+    """Read the export state file of an output directory. The file is not
+    trusted, the state is ignored unless all file names are plain file
+    names."""
+    try:
+        with open(os.path.join(outdir, EXPORT_STATE_FILE)) as state_fp:
+            state = json.load(state_fp)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(state, dict) or \
+            not isinstance(state.get('files', []), list):
+        return {}
+    fnames = state.get('files', [])
+    if state.get('git-meta') is not None:
+        fnames = fnames + [state['git-meta']]
+    if not all([is_plain_fname(fname) for fname in fnames]):
+        LOGGER.warning('Ignoring invalid export state file in %s', outdir)
+        return {}
+    return state
+
+def export_unchanged(repo, args):
+    """Check if outdir already has the files of an identical export"""
+    state = read_export_state(args.outdir)
+    if dict((key, state.get(key)) for key in ('export', 'git-meta')) != \
+            export_state(repo, args):
+        return False
+    for fname in state.get('files', []) + [args.git_meta]:
+        if not os.path.exists(os.path.join(args.outdir, fname)):
+            return False
+    return True
+
+def remove_previous_export(outdir):
+    """Remove the files of an earlier export recorded in the state file"""
+    state = read_export_state(outdir)
+    for fname in state.get('files', []) + [state.get('git-meta'),
+                                           EXPORT_STATE_FILE]:
+        path = os.path.join(outdir, fname) if fname else None
+        if path and os.path.isdir(path):
+            shutil.rmtree(path)
+        elif path and os.path.lexists(path):
+            os.unlink(path)
+
+def write_export_state(repo, args, fnames):
+    """Record the export in the state file of the output directory"""
+    state = export_state(repo, args)
+    state['files'] = fnames
+    state_fn = os.path.join(args.outdir, EXPORT_STATE_FILE)
+    try:
+        with open(state_fn + '.tmp', 'w') as state_fp:
+            json.dump(state, state_fp)
+        os.rename(state_fn + '.tmp', state_fn)
+    except (IOError, OSError) as err:
+        LOGGER.warning('Failed to write export state: %s', err)
+
+def run_gbs_export(repo, args, config, timer):
+    """Export sources with GBS, fetching full history if the export from a
+    shallow clone fails"""
+    from gbp_repocache import CachedRepoError
+
+    try:
+        fnames = gbs_export(repo, args, config, timer)
+    except ServiceError as err:
+        if err[1] != EXIT_ERR_GBS_EXPORT or not repo.is_shallow():
+            raise
+        # GBS may need history beyond the shallow clone, e.g. for
+        # generating patches against the upstream tag
+        LOGGER.info('Export from shallow clone failed, retrying with full '
+                    'history')
+        try:
+            with timer.phase('unshallow'):
+                repo.unshallow()
+        except CachedRepoError as c_err:
+            raise ServiceError('RepoCache: %s' % c_err, EXIT_ERR_SERVICE)
+        fnames = gbs_export(repo, args, config, timer)
+    return fnames
+
+def refresh_slot(config, cache_url):
+    """Acquire a background refresh slot for a repository, returns the locked
+    slot files or None if the repository is already being refreshed or all
+    slots are taken"""
+    slot_dir = os.path.join(config['repo-cache-dir'], '.refresh')
+    if not os.path.isdir(slot_dir):
+        os.makedirs(slot_dir)
+    locks = []
+    for name in [hashlib.sha1(cache_url).hexdigest()] + \
+                ['slot-%d' % num for num in
+                    range(config_int(config, 'repo-cache-swr-refreshes'))]:
+        lock = open(os.path.join(slot_dir, name + '.lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            if not locks:
+                # Repository refresh already pending
+                return None
+            continue
+        locks.append(lock)
+        if len(locks) == 2:
+            return locks
+    for lock in locks:
+        lock.close()
+    return None
+
+def refresh_repo(config, url):
+    """Fetch the remote of a cached repository"""
+    from gbp_repocache import CachedRepoError
+    from obs_service_gbp_utils import str_to_bool
+    from obs_service_gbs.repocache import ServiceCachedRepo
+
+    started = time.time()
+    cache_url = repo_cache_url(config, url)
+    locks = refresh_slot(config, cache_url)
+    if not locks:
+        LOGGER.debug('No free slot for refreshing %s', url)
+        return
+    try:
+        # Nothing to do if someone else fetched after we were started
+        repo = ServiceCachedRepo(config['repo-cache-dir'], url,
+                    bare=config['export-mode'] != 'checkout',
+                    refs_hack=str_to_bool(config['repo-cache-refs-hack']),
+                    fresh_since=started, cache_url=cache_url,
+                    family=get_repo_family(config, cache_url),
+                    layout=config['repo-cache-layout'],
+                    fetch_timeout=config_int(config,
+                                             'repo-cache-fetch-timeout'))
+        update_cache_index(config, repo)
+        repo.close()
+    except CachedRepoError as err:
+        LOGGER.warning('Background refresh of %s failed: %s', url, err)
+    finally:
+        # Per-repository lock files are not needed after the refresh
+        try:
+            os.unlink(locks[0].name)
+        except OSError:
+            pass
+        for lock in locks:
+            lock.close()
+
+def refresh_in_background(config, url):
+    """Refresh a cached repository in a detached process, after the service
+    run has finished with the repository"""
+    LOGGER.info('Refreshing repository cache in the background')
+    try:
+        pid = os.fork()
+    except OSError as err:
+        LOGGER.warning('Failed to start background refresh: %s', err)
+        return
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            # Don't keep the output of the service run or any locks of the
+            # parent open
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+            refresh_repo(config, url)
+    except Exception: # pylint: disable=W0703
+        pass
+    finally:
+        os._exit(0)
+
+def export_revision(repo, args, config, timer):
+    """Export sources and write git-meta"""
+    if args.skip_unchanged:
+        try:
+            remove_previous_export(args.outdir)
+        except (IOError, OSError) as err:
+            raise ServiceError('Failed to remove previous export: %s' % err,
+                               EXIT_ERR_SERVICE)
+    fnames = export_sources(repo, args, config, timer)
+
+    # Write git-meta
+    if args.git_meta:
+        with timer.phase('git-meta'):
+            from obs_service_gbp_utils import (GbpServiceError,
+                                               write_treeish_meta)
+            try:
+                write_treeish_meta(repo.repo, args.revision, args.outdir,
+                                   args.git_meta)
+            except GbpServiceError as err:
+                raise ServiceError(str(err), EXIT_ERR_SERVICE)
+    if args.skip_unchanged:
+        write_export_state(repo, args, fnames)
+
+def write_metrics(path, timer, args, ret, repo=None):
+    """Write timing metrics of the service run"""
+    try:
+        timer.write(path, url=args.url, revision=args.revision, exit_code=ret,
+                    offline_fallback=bool(repo and repo.offline))
+    except IOError as err:
+        LOGGER.warning('Failed to write metrics: %s', err)
 
 def integer_list(string):
     """Convert a string of comma-separated integers into a list of ints"""
@@ -181,9 +821,6 @@ def integer_list(string):
 
 def parse_args(argv):
     """Argument parser"""
-    default_configs = ['/etc/obs/services/gbs',
-                       '~/.obs/gbs']
-
     parser = argparse.ArgumentParser()
     parser.add_argument('--url', help='Remote repository URL', required=True)
     parser.add_argument('--outdir', help='Output direcory',
@@ -197,6 +834,18 @@ def parse_args(argv):
     parser.add_argument('--git-meta', metavar='FILENAME',
                         help='Create a json-formatted file FILENAME containing'
                              'metadata about the exported revision')
+    parser.add_argument('--clone-depth', metavar='DEPTH', type=int,
+                        help='History depth of a new clone in the repository '
+                             'cache, 0 means full history')
+    parser.add_argument('--clone-filter', metavar='FILTER',
+                        help='Object filter of a new clone in the repository '
+                             'cache, e.g. blob:none')
+    parser.add_argument('--skip-unchanged', choices=['yes', 'no'],
+                        help='Do nothing if the files in outdir are from an '
+                             'identical earlier export, requires --git-meta')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='Profile the service and GBS, writing profile '
+                             'data into DIR')
     parser.add_argument('--error-pkg', metavar='EXIT_CODES', type=integer_list,
                         default=[],
                         help='Comma-separated list of exit codes that cause '
@@ -204,25 +853,29 @@ def parse_args(argv):
                              'causing a service error.')
     args = parser.parse_args(argv)
     if not args.config:
-        args.config = default_configs
+        args.config = DEFAULT_CONFIGS
 
     return args
 
-def main(argv=None):
-    """Main function"""
+def main(argv=None, timer=None, fresh_since=None):
+    """Main function, the remote is not re-fetched if it has been fetched
+    after fresh_since"""
 
     ret = EXIT_OK
+    timer = timer or PhaseTimer()
     args = parse_args(argv)
     args.outdir = os.path.abspath(args.outdir)
+    profiler = None
+    if args.profile:
+        args.profile = os.path.abspath(args.profile)
+        profiler = cProfile.Profile()
+        profiler.enable()
 
     if args.verbose == 'yes':
         gbplog.setup(color='auto', verbose=True)
         LOGGER.setLevel(gbplog.DEBUG)
-        gbp_repocache.LOGGER.setLevel(gbplog.DEBUG)
-        gbs_log.setup(verbose=True)
     else:
         gbplog.setup(color='auto', verbose=False)
-        gbs_log.setup(verbose=False)
     # Add a new handler writing to a tempfile into the root logger
     file_log = tempfile.NamedTemporaryFile(prefix='gbs-service_')
     file_handler = gbplog.GbpStreamHandler(file_log)
@@ -238,28 +891,26 @@ def main(argv=None):
             LOGGER.error('Failed to create outdir: %s', err)
             return EXIT_ERR_SERVICE
 
+    config = None
+    repo = None
     try:
-        config = read_config(args.config)
-        # Create / update cached repository
-        refs_hack = str_to_bool(config['repo-cache-refs-hack'])
-        try:
-            repo = CachedRepo(config['repo-cache-dir'], args.url,
-                              refs_hack=refs_hack)
-            args.revision = repo.update_working_copy(args.revision,
-                                                     submodules=False)
-        except CachedRepoError as err:
-            raise ServiceError('RepoCache: %s' % err, EXIT_ERR_SERVICE)
-
-        # Export sources with GBS
-        gbs_export(repo, args, config)
-
-        # Write git-meta
-        if args.git_meta:
-            try:
-                write_treeish_meta(repo.repo, args.revision, args.outdir,
-                                   args.git_meta)
-            except GbpServiceError as err:
-                raise ServiceError(str(err), EXIT_ERR_SERVICE)
+        with timer.phase('config'):
+            config = read_config(args.config)
+            check_config(args, config)
+        if args.profile and not profiler:
+            # Profiling enabled in config
+            profiler = cProfile.Profile()
+            profiler.enable()
+        repo = update_repo_cache(args, config, timer, fresh_since)
+        if args.skip_unchanged and export_unchanged(repo, args):
+            LOGGER.info('Revision %s already exported, leaving the files '
+                        'untouched', args.revision)
+        else:
+            export_revision(repo, args, config, timer)
+
+        with timer.phase('evict'):
+            update_cache_index(config, repo, last_export=time.time())
+            evict_repo_cache(config)
     except ServiceError as err:
         LOGGER.error(err[0])
         if err[1] in args.error_pkg:
@@ -272,6 +923,14 @@ def main(argv=None):
         else:
             ret = err[1]
     finally:
+        if repo and repo.refresh_needed:
+            # Also after failures, the cached refs may be the cause
+            refresh_in_background(config, args.url)
+        if profiler:
+            profiler.disable()
+            save_profile(profiler, args, 'service')
+        if config and config['metrics-file']:
+            write_metrics(config['metrics-file'], timer, args, ret, repo)
         gbplog.getLogger().removeHandler(file_handler)
         file_log.close()
 
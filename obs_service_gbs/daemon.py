@@ -0,0 +1,209 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Persistent daemon running the GBS source service
+
+The daemon keeps GBS and git-buildpackage modules loaded and serves export
+requests from the service entry point over a Unix socket. Every request is
+handled in a forked child so that requests are isolated from each other and
+from the daemon itself.
+"""
+
+import argparse
+import errno
+import json
+import os
+import signal
+import socket
+import sys
+
+import gbp.log as gbplog
+
+from obs_service_gbs import command
+from obs_service_gbs.client import DEFAULT_SOCKET, ENV_PREFIX, EXIT_MARKER
+from obs_service_gbs.command import (DEFAULT_CONFIGS, EXIT_ERR_SERVICE,
+                LOGGER, ServiceError, read_config, start_worker_pool)
+from obs_service_gbs.worker import stop_pool
+
+
+class ServiceDaemon(object):
+    """Unix socket server forking a service run for every request"""
+
+    def __init__(self, path, config=None):
+        self.path = path
+        # Config for the persistent GBS workers
+        self.config = config
+        self.pool = None
+        self.sock = None
+        self.children = set()
+        self.running = False
+
+    def _bind(self):
+        """Create the listening socket"""
+        if os.path.exists(self.path):
+            # Remove stale socket, if no-one is listening
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise socket.error(errno.EADDRINUSE, 'Daemon already running '
+                                   'at %s' % self.path)
+            finally:
+                probe.close()
+        sock_dir = os.path.dirname(self.path)
+        if sock_dir and not os.path.isdir(sock_dir):
+            os.makedirs(sock_dir)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.sock.listen(64)
+        # Wake up periodically for reaping children and checking for shutdown
+        self.sock.settimeout(1.0)
+
+    def _reap_children(self):
+        """Collect exited request handlers"""
+        for pid in list(self.children):
+            try:
+                wpid, _status = os.waitpid(pid, os.WNOHANG)
+            except OSError as err:
+                if err.errno != errno.ECHILD:
+                    raise
+                wpid = pid
+            if wpid:
+                self.children.discard(pid)
+
+    def _stop(self, _signum, _frame):
+        """Signal handler for shutting down the daemon"""
+        self.running = False
+
+    def serve(self):
+        """Serve requests until SIGTERM or SIGINT"""
+        self._bind()
+        self.running = True
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        LOGGER.info('GBS service daemon listening on %s', self.path)
+        try:
+            # Forked request handlers inherit the loaded modules
+            command.preload_modules()
+            if self.config:
+                self.pool = start_worker_pool(self.config)
+            while self.running:
+                self._reap_children()
+                if self.pool:
+                    self.pool.maintain()
+                try:
+                    conn, _addr = self.sock.accept()
+                except socket.timeout:
+                    continue
+                except socket.error as err:
+                    if err.errno == errno.EINTR:
+                        continue
+                    raise
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    signal.signal(signal.SIGINT, signal.SIG_DFL)
+                    self.sock.close()
+                    os._exit(handle_request(conn))
+                conn.close()
+                self.children.add(pid)
+        finally:
+            stop_pool()
+            self.sock.close()
+            os.unlink(self.path)
+            LOGGER.info('GBS service daemon stopped')
+
+
+def handle_request(conn):
+    """Run one service request, called in the forked child"""
+    # Make sure that the socket is blocking, it inherits the timeout of the
+    # listening socket
+    conn.settimeout(None)
+    try:
+        request = json.loads(conn.makefile('r').readline())
+        argv = [str(arg) for arg in request['argv']]
+    except (ValueError, KeyError, TypeError) as err:
+        conn.sendall('ERROR: invalid daemon request: %s\n%s%d\n' %
+                     (err, EXIT_MARKER, EXIT_ERR_SERVICE))
+        return 1
+
+    # Replicate the environment of the client
+    for key in os.environ.keys():
+        if key.startswith(ENV_PREFIX):
+            del os.environ[key]
+    for key, val in request.get('env', {}).items():
+        if key.startswith(ENV_PREFIX):
+            os.environ[str(key)] = str(val)
+    sys.argv = [str(request.get('prog', 'gbs'))] + argv
+
+    # Redirect all output to the client
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(conn.fileno(), sys.stdout.fileno())
+    os.dup2(conn.fileno(), sys.stderr.fileno())
+
+    try:
+        os.chdir(request['cwd'])
+        ret = command.main(argv)
+    except SystemExit as err:
+        if err.code is None:
+            ret = 0
+        elif isinstance(err.code, int):
+            ret = err.code
+        else:
+            sys.stderr.write('%s\n' % err.code)
+            ret = EXIT_ERR_SERVICE
+    except Exception as err: # pylint: disable=W0703
+        LOGGER.error('Service crashed in daemon: %s', err)
+        ret = EXIT_ERR_SERVICE
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall('%s%d\n' % (EXIT_MARKER, ret))
+    conn.close()
+    return 0
+
+def parse_args(argv):
+    """Argument parser"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+                        help='Unix socket to listen on, default is %(default)s')
+    parser.add_argument('--config', action='append',
+                        help='Config file to use, can be given multiple '
+                             'times. Only used for the GBS worker settings, '
+                             'service runs read the config themselves')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='Verbose output')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """Main function"""
+    args = parse_args(argv)
+    gbplog.setup(color='auto', verbose=args.verbose)
+    try:
+        config = read_config(args.config or DEFAULT_CONFIGS)
+        ServiceDaemon(os.path.abspath(args.socket), config).serve()
+    except ServiceError as err:
+        LOGGER.error(err[0])
+        return err[1]
+    except (OSError, socket.error) as err:
+        LOGGER.error('GBS service daemon failed: %s', err)
+        return EXIT_ERR_SERVICE
+    return 0
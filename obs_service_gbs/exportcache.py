@@ -0,0 +1,262 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Cache of GBS export results"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import gbp.log as gbplog
+
+from obs_service_gbs.utils import disk_usage
+
+
+LOGGER = gbplog.getLogger('source_service')
+
+
+def _copy(src, dst):
+    """Copy a file or a directory, overwriting dst"""
+    if os.path.isdir(src):
+        if os.path.isdir(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst, symlinks=True)
+    else:
+        shutil.copy2(src, dst)
+
+
+class ExportCache(object):
+    """Content-addressed store of exported packaging files
+
+    Entries are keyed by the repository URL, the exported commit and the
+    GBS export arguments. Cache errors are never fatal: they are logged and
+    the cache is simply bypassed. Concurrent exports with the same key can be
+    serialized with lock() so that only the first one runs GBS and the rest
+    get its results from the cache. The runs waiting for the lock are
+    recorded, so that results can be stored only when they are wanted.
+    """
+
+    def __init__(self, cachedir, max_size=0, max_age=0, evict_interval=0):
+        self.cachedir = os.path.abspath(cachedir)
+        # Maximum total size in bytes and maximum entry age in seconds, zero
+        # means unlimited
+        self.max_size = max_size
+        self.max_age = max_age
+        # Minimum interval between evictions in seconds, eviction walks
+        # through the whole cache
+        self.evict_interval = evict_interval
+
+    @staticmethod
+    def key(url, commit, gbs_args):
+        """Cache key of an export"""
+        export_args = dict((key, val) for key, val in vars(gbs_args).items()
+                                if key not in ('outdir', 'gitdir'))
+        data = json.dumps([url, commit, export_args], sort_keys=True)
+        return hashlib.sha1(data).hexdigest()
+
+    def _entry(self, key):
+        """Directory of a cache entry"""
+        return os.path.join(self.cachedir, key)
+
+    def _lock_fn(self, key):
+        """Lock file of a cache entry"""
+        return os.path.join(self.cachedir, '.locks', key + '.lock')
+
+    def _waiting_fn(self, key):
+        """File marking that someone is waiting for the lock of an entry"""
+        return os.path.join(self.cachedir, '.locks', key + '.waiting')
+
+    def _acquire(self, key):
+        """Lock a cache entry, returns the lock file object (None on errors)
+        and whether an identical export in progress was waited for"""
+        lock_fn = self._lock_fn(key)
+        waited = False
+        try:
+            if not os.path.isdir(os.path.dirname(lock_fn)):
+                os.makedirs(os.path.dirname(lock_fn))
+            while True:
+                lock_fp = open(lock_fn, 'a')
+                try:
+                    fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    if not waited:
+                        LOGGER.info('Waiting for an identical export in '
+                                    'progress')
+                        open(self._waiting_fn(key), 'a').close()
+                        waited = True
+                    fcntl.flock(lock_fp, fcntl.LOCK_EX)
+                # The previous holder may have removed the lock file
+                try:
+                    if os.path.samestat(os.fstat(lock_fp.fileno()),
+                                        os.stat(lock_fn)):
+                        return lock_fp, waited
+                except OSError:
+                    pass
+                lock_fp.close()
+        except (IOError, OSError) as err:
+            LOGGER.warning('Failed to lock export cache entry: %s', err)
+            return None, waited
+
+    @contextmanager
+    def lock(self, key, remove=False):
+        """Context manager holding an exclusive lock of a cache entry, gives
+        True if an identical export in progress was waited for. With
+        remove=True the lock file is removed when the lock is released."""
+        lock_fp, waited = self._acquire(key)
+        try:
+            yield waited
+        finally:
+            if lock_fp:
+                if remove:
+                    for fname in (self._waiting_fn(key), self._lock_fn(key)):
+                        try:
+                            os.unlink(fname)
+                        except OSError:
+                            pass
+                lock_fp.close()
+
+    def has_waiters(self, key):
+        """Check if someone has waited for the lock of an entry"""
+        return os.path.exists(self._waiting_fn(key))
+
+    def restore(self, key, outdir, newer_than=None):
+        """Copy cached files to outdir, returns the list of files restored or
+        None if the export is not found in the cache or the entry is older
+        than newer_than (timestamp)"""
+        entry = self._entry(key)
+        try:
+            fnames = os.listdir(entry)
+            mtime = os.stat(entry).st_mtime
+        except OSError:
+            return None
+        if self.max_age and time.time() - mtime > self.max_age:
+            return None
+        if newer_than is not None and mtime < newer_than:
+            return None
+        try:
+            # Update timestamp for LRU eviction
+            os.utime(entry, None)
+            for fname in fnames:
+                _copy(os.path.join(entry, fname), os.path.join(outdir, fname))
+        except (IOError, OSError) as err:
+            LOGGER.warning('Failed to restore files from export cache: %s',
+                           err)
+            return None
+        LOGGER.debug('Restored %s from export cache entry %s', fnames, key)
+        return fnames
+
+    def store(self, key, srcdir, fnames):
+        """Add files to the cache, replacing an existing entry. The lock of
+        the entry must be held."""
+        tmpdir = None
+        try:
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cachedir)
+            for fname in fnames:
+                _copy(os.path.join(srcdir, fname), os.path.join(tmpdir, fname))
+            os.chmod(tmpdir, 0755)
+            # Expired entry
+            if os.path.isdir(self._entry(key)):
+                shutil.rmtree(self._entry(key))
+            # Atomically publish the new entry
+            os.rename(tmpdir, self._entry(key))
+            tmpdir = None
+            LOGGER.debug('Stored %s in export cache entry %s', fnames, key)
+        except (IOError, OSError) as err:
+            LOGGER.warning('Failed to store export in cache: %s', err)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def evict(self):
+        """Remove entries exceeding the age and size limits, at most once
+        in evict_interval seconds"""
+        if not self.max_size and not self.max_age:
+            return
+        now = time.time()
+        stamp = os.path.join(self.cachedir, '.last-eviction')
+        if self.evict_interval:
+            try:
+                if now - os.path.getmtime(stamp) < self.evict_interval:
+                    return
+            except OSError:
+                pass
+            try:
+                open(stamp, 'w').close()
+            except IOError as err:
+                LOGGER.warning('Failed to update export cache eviction '
+                               'timestamp: %s', err)
+        try:
+            keys = os.listdir(self.cachedir)
+        except OSError:
+            return
+        entries = []
+        for key in keys:
+            entry = self._entry(key)
+            try:
+                mtime = os.stat(entry).st_mtime
+            except OSError:
+                continue
+            if key.startswith('.tmp-'):
+                # Leftovers of interrupted stores
+                if now - mtime > 3600:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            if key.startswith('.'):
+                continue
+            entries.append((mtime, key, disk_usage(entry)))
+        # Least recently used first
+        entries.sort()
+        total_size = sum([entry[2] for entry in entries])
+        for mtime, key, size in entries:
+            expired = self.max_age and now - mtime > self.max_age
+            if expired or (self.max_size and total_size > self.max_size):
+                LOGGER.debug('Evicting export cache entry %s', key)
+                shutil.rmtree(self._entry(key), ignore_errors=True)
+                total_size -= size
+        self._evict_locks(now)
+
+    def _evict_locks(self, now):
+        """Remove old lock files of entries not in the cache"""
+        lock_dir = os.path.join(self.cachedir, '.locks')
+        try:
+            lock_fns = os.listdir(lock_dir)
+        except OSError:
+            return
+        for lock_fn in lock_fns:
+            key = os.path.splitext(lock_fn)[0]
+            lock_fn = os.path.join(lock_dir, lock_fn)
+            try:
+                if os.path.exists(self._entry(key)) or \
+                        now - os.stat(lock_fn).st_mtime < 3600:
+                    continue
+                if lock_fn.endswith('.waiting'):
+                    # Left behind by a failed export
+                    os.unlink(lock_fn)
+                    continue
+                with open(lock_fn, 'a') as lock_fp:
+                    fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.unlink(lock_fn)
+            except (IOError, OSError):
+                pass
@@ -0,0 +1,77 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Timing instrumentation of the GBS source service"""
+
+import fcntl
+import json
+import resource
+import time
+from contextlib import contextmanager
+
+
+def _cpu_time(rusage):
+    """Total CPU time of a rusage struct"""
+    return rusage.ru_utime + rusage.ru_stime
+
+
+class PhaseTimer(object):
+    """Record wall time, CPU time and peak RSS of service phases
+
+    Resource usage is recorded separately for the service process itself and
+    for its children, e.g. git and the forked GBS process.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager for timing one phase"""
+        wall_start = time.time()
+        self_start = resource.getrusage(resource.RUSAGE_SELF)
+        child_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            self_end = resource.getrusage(resource.RUSAGE_SELF)
+            child_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            # Max RSS is in kilobytes, and for children it is the peak of
+            # the largest child so far
+            self.phases.append({
+                'name': name,
+                'wall': time.time() - wall_start,
+                'cpu': _cpu_time(self_end) - _cpu_time(self_start),
+                'maxrss': self_end.ru_maxrss,
+                'child_cpu': _cpu_time(child_end) - _cpu_time(child_start),
+                'child_maxrss': child_end.ru_maxrss})
+
+    def record(self, **fields):
+        """Metrics record of the run"""
+        record = {'time': self.start,
+                  'wall': time.time() - self.start,
+                  'phases': self.phases}
+        record.update(fields)
+        return record
+
+    def write(self, path, **fields):
+        """Append a JSON record of the run to a file"""
+        with open(path, 'a') as metrics_fp:
+            fcntl.flock(metrics_fp, fcntl.LOCK_EX)
+            metrics_fp.write(json.dumps(self.record(**fields)) + '\n')
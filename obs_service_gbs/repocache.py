@@ -0,0 +1,864 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Repository cache of the GBS source service"""
+
+import fcntl
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+
+import gbp.log as gbplog
+from gbp.git.repository import GitRepositoryError
+from gbp_repocache import CachedRepo, CachedRepoError, MirrorGitRepository
+
+from obs_service_gbs.utils import (ChildCallError, DeadlineExceeded,
+                call_with_deadline, disk_usage)
+
+
+LOGGER = gbplog.getLogger('source_service')
+
+SHA1_RE = re.compile(r'^[0-9a-f]{40}$')
+
+# User part of URLs, e.g. ssh://user@host/path and user@host:path
+URL_USER_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*://)[^@/]+@')
+SCP_USER_RE = re.compile(r'^[^@/:]+@(?=[^/:]+:)')
+
+
+class CachedRepoTimeout(CachedRepoError):
+    """Remote operation of the repository cache timed out"""
+    pass
+
+
+def is_sha1(revision):
+    """Check if a revision is a full commit id, i.e. immutable"""
+    return bool(revision and SHA1_RE.match(revision))
+
+def canonical_url(url, aliases=(), strip_user=False, strip_suffix=False):
+    """Canonical form of a repository URL, identifying the repository in the
+    cache. Aliases is a list of (alias, canonical) URL prefix pairs."""
+    url = url.strip().rstrip('/')
+    if strip_user:
+        url = SCP_USER_RE.sub('', URL_USER_RE.sub(r'\1', url))
+    for alias, canonical in aliases:
+        alias = alias.rstrip('/')
+        if url == alias or (url.startswith(alias) and
+                            url[len(alias)] in '/:'):
+            url = canonical.rstrip('/') + url[len(alias):]
+            break
+    if strip_suffix and url.endswith('.git'):
+        url = url[:-len('.git')]
+    return url
+
+def read_repo_state(repodir):
+    """Read the state file of a cached repository"""
+    try:
+        with open(repodir + '.state') as state_fp:
+            return json.load(state_fp)
+    except (IOError, ValueError):
+        return {}
+
+def iter_cached_repos(base_dir):
+    """Iterate over the cached repositories under base_dir, in both the flat
+    and the sharded layout"""
+    for pattern in (('*', '*.lock'), ('*', '*', '*.lock')):
+        for lock_fn in glob.glob(os.path.join(base_dir, *pattern)):
+            repodir = lock_fn[:-len('.lock')]
+            if os.path.isdir(repodir):
+                yield repodir
+
+def scan_repos(base_dir):
+    """Read the state of all cached repositories by walking through the
+    cache, returns a dict of repodir: state"""
+    repos = {}
+    for repodir in iter_cached_repos(base_dir):
+        state = read_repo_state(repodir)
+        if state.get('last_access') is None:
+            state['last_access'] = os.path.getmtime(repodir)
+        if state.get('size') is None:
+            state['size'] = disk_usage(repodir)
+        repos[repodir] = state
+    return repos
+
+def is_sharded(base_dir, repodir):
+    """Check if a cached repository is in the sharded layout"""
+    return os.path.dirname(os.path.dirname(os.path.abspath(repodir))) != \
+            os.path.abspath(base_dir)
+
+def sharded_path(base_dir, repodir):
+    """Path of a cached repository of the flat layout in the sharded
+    layout"""
+    url_hash = os.path.basename(os.path.dirname(repodir))
+    return os.path.join(base_dir, url_hash[:2], url_hash,
+                        os.path.basename(repodir))
+
+def migrate_repo(repodir, new_repodir):
+    """Move a cached repository, returns False if it is in use"""
+    locks = []
+    try:
+        for path in (repodir, new_repodir):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            locks.append(open(path + '.lock', 'a'))
+            fcntl.flock(locks[-1], fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if not os.path.isdir(repodir) or os.path.exists(new_repodir):
+            LOGGER.warning('Not migrating %s, %s already exists', repodir,
+                           new_repodir)
+            return False
+        LOGGER.info('Moving %s to %s', repodir, new_repodir)
+        os.rename(repodir, new_repodir)
+        if os.path.exists(repodir + '.state'):
+            os.rename(repodir + '.state', new_repodir + '.state')
+        # Runs already waiting for the old lock notice that the repository
+        # is gone and switch to the new location
+        os.unlink(repodir + '.lock')
+        try:
+            os.rmdir(os.path.dirname(repodir))
+        except OSError:
+            pass
+        return True
+    except IOError as err:
+        LOGGER.debug('Not migrating %s: %s', repodir, err)
+        return False
+    except OSError as err:
+        LOGGER.warning('Failed to migrate %s: %s', repodir, err)
+        return False
+    finally:
+        for lock in locks:
+            lock.close()
+
+def evict_repo(repodir):
+    """Remove a cached repository, returns False if it is in use"""
+    try:
+        lock = open(repodir + '.lock', 'w')
+    except IOError as err:
+        LOGGER.warning('Unable to open repo lock file: %s', err)
+        return False
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            LOGGER.debug('Not evicting %s, repository in use', repodir)
+            return False
+        LOGGER.info('Evicting %s from repo cache', repodir)
+        # The lock file is left in place so that service runs already
+        # waiting on it stay serialized with new ones
+        shutil.rmtree(repodir, ignore_errors=True)
+        if os.path.exists(repodir + '.state'):
+            os.unlink(repodir + '.state')
+        return True
+    finally:
+        lock.close()
+
+def evict_repos(base_dir, high_watermark, low_watermark, index=None):
+    """Evict least recently used repositories if the total size of the
+    repository cache exceeds high_watermark, until it is below
+    low_watermark. Repositories locked by other processes are never evicted.
+    The cache is only walked through if index (CacheIndex) is not given or
+    not available. Returns the list of evicted repositories."""
+    repos = index.entries() if index else None
+    if repos is None:
+        repos = scan_repos(base_dir)
+        if index:
+            index.rebuild(repos)
+    entries = []
+    for repodir, state in repos.items():
+        if not os.path.isdir(repodir):
+            # Removed or migrated by someone else
+            if index:
+                index.remove(repodir)
+            continue
+        size = state.get('size')
+        if size is None:
+            # Fetched since the size was last computed
+            size = disk_usage(repodir)
+            if index:
+                index.update(repodir, {'size': size})
+        entries.append((state.get('last_access', 0), repodir, size))
+    total_size = sum([entry[2] for entry in entries])
+    LOGGER.debug('Repo cache size is %d bytes', total_size)
+    if total_size <= high_watermark:
+        return []
+
+    evicted = []
+    for _last_access, repodir, size in sorted(entries):
+        if total_size <= low_watermark:
+            break
+        if evict_repo(repodir):
+            total_size -= size
+            evicted.append(repodir)
+            if index:
+                index.remove(repodir)
+    return evicted
+
+def git_cmd(gitdir, args, stdin=None):
+    """Run a git command, returns its stdout"""
+    LOGGER.debug('Running git %s', ' '.join(args))
+    popen = subprocess.Popen(['git'] + args, cwd=gitdir,
+                             stdin=None if stdin is None else subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = popen.communicate(stdin)
+    if popen.returncode:
+        raise GitRepositoryError('git %s failed: %s' %
+                                 (args[0], stderr.strip()))
+    return stdout
+
+
+class RepoFamily(object):
+    """Shared object store of a family of related repositories
+
+    Members of the family, e.g. forks of the same upstream repository,
+    borrow objects from the store through git alternates so that only their
+    unique objects are fetched and stored separately. Objects are never
+    pruned from the store as members may depend on them.
+    """
+
+    def __init__(self, base_dir, name, url, members):
+        self.name = name
+        self.url = url
+        # URL patterns of the members
+        self.members = members
+        self.path = os.path.join(os.path.abspath(base_dir), '.families',
+                                 name + '.git')
+
+    def matches(self, url):
+        """Check if url belongs to the family"""
+        for pattern in self.members:
+            if fnmatch.fnmatch(url, pattern):
+                return True
+        return False
+
+    def _clone(self):
+        """Create the shared object store"""
+        LOGGER.info("Cloning shared object store of repository family '%s' "
+                    "from %s", self.name, self.url)
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        git_cmd(None, ['clone', '-q', '--mirror', self.url, tmp_path])
+        for key, val in (('gc.pruneExpire', 'never'),
+                         ('gc.reflogExpireUnreachable', 'never')):
+            git_cmd(tmp_path, ['config', key, val])
+        os.rename(tmp_path, self.path)
+
+    def update(self):
+        """Clone or fetch the shared object store, returns its object
+        directory or None if the store is not available"""
+        lock = None
+        wait_start = time.time()
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            # Lock file mtime tells when the store was last updated
+            lock = open(self.path + '.lock', 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Pushes done after the fetch has started may not be included
+            fetch_start = time.time()
+            if not os.path.exists(self.path):
+                self._clone()
+            elif os.path.getmtime(self.path + '.lock') < wait_start:
+                LOGGER.info("Fetching shared object store of repository "
+                            "family '%s'", self.name)
+                git_cmd(self.path, ['fetch', '-q', 'origin'])
+            else:
+                fetch_start = None
+            if fetch_start:
+                # Mark the store as up-to-date for runs waiting for the lock
+                os.utime(self.path + '.lock', (fetch_start, fetch_start))
+        except (GitRepositoryError, IOError, OSError) as err:
+            LOGGER.warning("Failed to update shared object store of "
+                           "repository family '%s': %s", self.name, err)
+        finally:
+            if lock:
+                lock.close()
+        if not os.path.isdir(self.path):
+            return None
+        return os.path.join(self.path, 'objects')
+
+
+class ServiceCachedRepo(CachedRepo):
+    """Cached repository that fetches from the remote only when needed
+
+    Uses the same on-disk layout and locking as gbp-repocache so that the
+    repository cache can still be shared with the git-buildpackage source
+    service.
+    """
+    # pylint: disable=W0231
+
+    def __init__(self, base_dir, url, bare=False, refs_hack=False,
+                 revision=None, fetch_ttl=0, ls_remote=False, depth=0,
+                 clone_filter=None, fresh_since=None, cache_url=None,
+                 family=None, layout='flat', swr_max_age=0, fetch_timeout=0,
+                 offline_fallback=False, deadline=0, shared=False):
+        self.basedir = os.path.abspath(base_dir)
+        # Remote is always fetched from the requested URL, but the cached
+        # clone is identified by the canonical URL of the repository
+        self.url = url
+        self.cache_url = cache_url or url
+        self.layout = layout
+        self.repodir = self.cache_path(self.basedir, self.cache_url, layout)
+        if layout != 'flat':
+            # Use repositories not migrated from the flat layout, yet
+            flat_repodir = self.cache_path(self.basedir, self.cache_url)
+            if os.path.exists(flat_repodir):
+                self.repodir = flat_repodir
+        self.repo = None
+        self.lock = None
+        # Symbolic revisions are resolved without fetching if the remote has
+        # been fetched less than fetch_ttl seconds ago
+        self.fetch_ttl = fetch_ttl
+        # Symbolic revisions are resolved from cached refs fetched less than
+        # swr_max_age seconds ago, leaving the fetch to a background refresh
+        # (stale-while-revalidate)
+        self.swr_max_age = swr_max_age
+        self.refresh_needed = False
+        # Fetches taking longer than fetch_timeout seconds are aborted, and
+        # all remote operations must be done in deadline seconds after
+        # getting the repository lock
+        self.fetch_timeout = fetch_timeout
+        self.deadline = deadline
+        self.deadline_at = None
+        # Use the cached clone if the fetch fails and the requested revision
+        # is found in it
+        self.offline_fallback = offline_fallback
+        self.offline = False
+        # Check the remote ref of symbolic revisions with ls-remote before
+        # doing a full fetch
+        self.ls_remote = ls_remote
+        # History depth and object filter (e.g. blob:none) used when creating
+        # a new clone
+        self.depth = depth
+        self.clone_filter = clone_filter
+        # Repository family whose shared object store new clones borrow from
+        self.family = family
+        self.lock_shared = False
+        # Whether the remote was fetched (or cloned) in this run
+        self.fetched = False
+
+        self._init_git_repo(bare, refs_hack, revision, fresh_since, shared)
+
+    @staticmethod
+    def cache_path(base_dir, url, layout='flat'):
+        """Path of the cached clone of url. The sharded layout has an extra
+        directory level for keeping directory sizes small in big caches."""
+        base_name = os.path.basename(url)
+        base_name += '' if base_name.endswith('.git') else '.git'
+        url_hash = hashlib.sha1(url).hexdigest()
+        if layout == 'sharded':
+            return os.path.join(base_dir, url_hash[:2], url_hash, base_name)
+        return os.path.join(base_dir, url_hash, base_name)
+
+    def _acquire_lock(self, shared=False):
+        """Acquire the repository lock, exclusive or shared"""
+        LOGGER.debug('Acquiring %s repository lock for %s',
+                     'shared' if shared else 'exclusive', self.repodir)
+        try:
+            lock_dir = os.path.dirname(self.repodir)
+            if not os.path.isdir(lock_dir):
+                os.makedirs(lock_dir)
+            self.lock = open(self.repodir + '.lock', 'w')
+        except (IOError, OSError) as err:
+            raise CachedRepoError('Unable to open repo lock file: %s' % err)
+        fcntl.flock(self.lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        self.lock_shared = shared
+        LOGGER.debug('Repository lock acquired')
+
+    def _lock_repo(self, shared=False):
+        """Lock the cached repository, following it if it is migrated to
+        the sharded layout while waiting for the lock"""
+        self._acquire_lock(shared)
+        new_repodir = self.cache_path(self.basedir, self.cache_url,
+                                      self.layout)
+        if self.repodir != new_repodir and not os.path.exists(self.repodir):
+            self._release_lock()
+            self.repodir = new_repodir
+            self._acquire_lock(shared)
+        if self.deadline:
+            self.deadline_at = time.time() + self.deadline
+
+    def _release_lock(self):
+        """Release the repository lock"""
+        if self.lock:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+            self.lock = None
+            self.lock_shared = False
+
+    def close(self):
+        """Close the repository, releasing the lock"""
+        self.repo = None
+        self._release_lock()
+
+    def read_state(self):
+        """Read the state file of the cached repository"""
+        return read_repo_state(self.repodir)
+
+    def _update_state(self, **kwargs):
+        """Update the state file of the cached repository"""
+        state = self.read_state()
+        state.update(kwargs, url=self.cache_url)
+        # Runs holding a shared lock may update the state concurrently
+        tmp_fn = '%s.state.%d.tmp' % (self.repodir, os.getpid())
+        try:
+            with open(tmp_fn, 'w') as state_fp:
+                json.dump(state, state_fp)
+            os.rename(tmp_fn, self.repodir + '.state')
+        except (IOError, OSError) as err:
+            LOGGER.warning('Failed to write repo cache state: %s', err)
+
+    def _open_usable(self, bare, refs_hack):
+        """Open an existing cached clone, returns None if there is no clone
+        or it is not of the requested type"""
+        if not os.path.exists(self.repodir):
+            return None
+        try:
+            repo = MirrorGitRepository(self.repodir)
+        except GitRepositoryError:
+            return None
+        if repo.bare == bare and (not refs_hack or
+                os.path.islink(os.path.join(repo.git_dir, 'refs'))):
+            return repo
+        return None
+
+    def _open_cached(self, bare, refs_hack):
+        """Open an existing cached clone, returns None if there is no usable
+        clone"""
+        if not os.path.exists(self.repodir):
+            return None
+        repo = self._open_usable(bare, refs_hack)
+        if repo:
+            return repo
+        LOGGER.info('Removing unusable repo cache %s', self.repodir)
+        try:
+            shutil.rmtree(self.repodir)
+        except OSError as err:
+            raise CachedRepoError('Failed to remove repo cache dir: %s' % err)
+        return None
+
+    def has_commit(self, revision):
+        """Check if a commit is found in the cached clone"""
+        try:
+            self.repo.rev_parse('%s^{commit}' % revision)
+        except GitRepositoryError:
+            return False
+        return True
+
+    def _need_fetch(self, revision, wait_start, ls_remote=True):
+        """Check if the remote needs to be fetched for resolving revision"""
+        if is_sha1(revision):
+            if self.has_commit(revision):
+                LOGGER.info('Commit %s found in repo cache, not fetching',
+                            revision)
+                return False
+            return True
+
+        last_fetch = self.read_state().get('last_fetch')
+        if last_fetch is None:
+            return True
+        if last_fetch >= wait_start:
+            # Someone else fetched while we were waiting for the lock
+            LOGGER.info('Remote was just fetched by another service run, '
+                        'not fetching')
+            return False
+        age = time.time() - last_fetch
+        if (age < self.fetch_ttl or age < self.swr_max_age) and \
+                not self._has_revision(revision):
+            # E.g. a branch created after the last fetch
+            LOGGER.info("'%s' not found in repo cache, fetching", revision)
+            return True
+        if age < self.fetch_ttl:
+            LOGGER.info('Remote fetched %d seconds ago, not fetching', age)
+            return False
+        if age < self.swr_max_age:
+            LOGGER.info('Remote fetched %d seconds ago, using cached refs and '
+                        'refreshing in the background', age)
+            self.refresh_needed = True
+            return False
+        if self.ls_remote and ls_remote and self._remote_unchanged(revision):
+            LOGGER.info("Remote ref '%s' unchanged, not fetching", revision)
+            return False
+        return True
+
+    def _has_revision(self, revision):
+        """Check if a revision can be resolved from the cached clone"""
+        if revision is None or revision == 'HEAD':
+            return self._local_ref('HEAD') is not None
+        return self.has_commit(revision)
+
+    def _local_ref(self, ref):
+        """Get the cached value of a remote ref, None if not found"""
+        fetch_head = os.path.join(self.repo.git_dir, 'FETCH_HEAD')
+        if ref == 'HEAD' and (not self.repo.bare or
+                              os.path.exists(fetch_head)):
+            # HEAD of the cached remote is recorded in FETCH_HEAD
+            try:
+                with open(fetch_head) as fetch_head_fp:
+                    return fetch_head_fp.readline().split()[0]
+            except (IOError, IndexError):
+                return None
+        try:
+            return self.repo.rev_parse(ref)
+        except GitRepositoryError:
+            return None
+
+    def _remote_unchanged(self, revision):
+        """Compare the remote ref(s) matching revision with the cached ones
+        using a lightweight ref advertisement"""
+        try:
+            output = call_with_deadline(self._remote_timeout(), git_cmd,
+                                        self.repodir,
+                                        ['ls-remote', 'origin', revision])
+        except (GitRepositoryError, DeadlineExceeded, ChildCallError) as err:
+            LOGGER.warning('ls-remote failed: %s', err)
+            return False
+        if revision.startswith('refs/') or revision == 'HEAD':
+            candidates = [revision]
+        else:
+            candidates = ['refs/heads/' + revision, 'refs/tags/' + revision]
+        remote_refs = dict([line.split('\t', 1)[::-1] for line in
+                                output.splitlines() if '\t' in line])
+        matches = [ref for ref in candidates if ref in remote_refs]
+        if not matches:
+            # Not a plain ref (e.g. 'master~1'), fetch to be sure
+            return False
+        for ref in matches:
+            if self._local_ref(ref) != remote_refs[ref]:
+                return False
+        return True
+
+    def _init_git_repo(self, bare, refs_hack, revision, fresh_since=None,
+                       shared=False):
+        """Clone or update the cached repository, fetches done after
+        fresh_since (by default, the time we start waiting for the lock) are
+        considered up-to-date. With shared=True the repository is left
+        locked with a shared lock, and the exclusive lock is only taken if
+        the clone needs to be created or updated."""
+        LOGGER.debug('Caching %s in %s', self.url, self.repodir)
+        wait_start = time.time() if fresh_since is None else fresh_since
+        self._lock_repo(shared)
+        checked = False
+        if shared:
+            self.repo = self._open_usable(bare, refs_hack)
+            if self.repo:
+                if not self._need_update(revision, wait_start):
+                    self._update_state(last_access=time.time())
+                    return
+                checked = True
+            # Other runs exporting from the clone are waited for
+            LOGGER.debug('Upgrading to an exclusive repository lock')
+            self.repo = None
+            self._release_lock()
+            self._lock_repo()
+        # Remote refs were already compared if the clone was checked above
+        self._update_repo(bare, refs_hack, revision, wait_start,
+                          ls_remote=not checked)
+        if shared:
+            self.share_lock()
+
+    def _need_update(self, revision, wait_start):
+        """Check if the cached clone needs to be modified for revision"""
+        if self.read_state().get('remote_url', self.url) != self.url:
+            return True
+        return self._need_fetch(revision, wait_start)
+
+    def _update_repo(self, bare, refs_hack, revision, wait_start,
+                     ls_remote=True):
+        """Clone or update the cached repository, the exclusive lock must be
+        held"""
+        self.repo = self._open_cached(bare, refs_hack)
+        if not self.repo:
+            self._clone(bare, refs_hack)
+        else:
+            if self.read_state().get('remote_url', self.url) != self.url:
+                # Cached through an alias of the requested URL
+                self._set_remote_url()
+            if self._need_fetch(revision, wait_start, ls_remote):
+                self._fetch_or_fallback(revision)
+        self._update_state(last_access=time.time())
+
+    def _fetch_or_fallback(self, revision):
+        """Fetch from the remote, falling back to the cached clone if the
+        fetch fails and the offline fallback is enabled"""
+        try:
+            self.fetch()
+        except CachedRepoError as err:
+            if not self.offline_fallback or revision is None:
+                raise
+            if revision == 'HEAD':
+                revision = self._local_ref('HEAD') or 'HEAD'
+            if not self.has_commit(revision):
+                raise
+            LOGGER.warning('%s, using the cached clone which may be '
+                           'outdated', err)
+            self.offline = True
+
+    def _remote_timeout(self):
+        """Time limit of a remote operation in seconds, zero for none"""
+        timeouts = []
+        if self.fetch_timeout:
+            timeouts.append(self.fetch_timeout)
+        if self.deadline_at:
+            timeouts.append(max(self.deadline_at - time.time(), 0.001))
+        return min(timeouts) if timeouts else 0
+
+    def _clone(self, bare, refs_hack):
+        """Create a new cached clone"""
+        LOGGER.info('Cloning from %s', self.url)
+        # Pushes done after the clone has started may not be included
+        fetch_start = time.time()
+        try:
+            call_with_deadline(self._remote_timeout(), self._clone_repo, bare,
+                               refs_hack)
+            self.repo = MirrorGitRepository(self.repodir)
+        except (GitRepositoryError, IOError, DeadlineExceeded,
+                ChildCallError) as err:
+            if os.path.exists(self.repodir):
+                shutil.rmtree(self.repodir)
+            if isinstance(err, DeadlineExceeded):
+                raise CachedRepoTimeout('Clone from remote timed out')
+            raise CachedRepoError('Failed to clone: %s' % err)
+        self.fetched = True
+        # Size is computed lazily, when the cache is scanned for eviction
+        self._update_state(last_fetch=fetch_start, remote_url=self.url,
+                           size=None)
+
+    def _clone_repo(self, bare, refs_hack):
+        """Clone the remote into the repository cache"""
+        partial = self.depth or self.clone_filter or self.family
+        if partial and refs_hack:
+            LOGGER.warning('Shallow, partial and family clones are not '
+                           'supported with the refs hack, doing a full clone')
+            partial = False
+        alternates = self.family.update() if partial and self.family else None
+        partial = self.depth or self.clone_filter or alternates
+        if partial:
+            self._clone_partial(bare, alternates)
+        else:
+            MirrorGitRepository.clone(self.repodir, self.url, bare=bare,
+                                      refs_hack=refs_hack)
+
+    def _set_remote_url(self):
+        """Fetch from the requested URL"""
+        LOGGER.debug('Setting remote URL of the cached clone to %s', self.url)
+        try:
+            git_cmd(self.repodir, ['remote', 'set-url', 'origin', self.url])
+        except GitRepositoryError as err:
+            raise CachedRepoError('Failed to set remote URL: %s' % err)
+        self._update_state(remote_url=self.url)
+
+    def _clone_partial(self, bare, alternates=None):
+        """Create a shallow and/or partial mirror clone, or one borrowing
+        objects from the alternates object directory"""
+        git_cmd(None, ['init', '-q'] + (['--bare'] if bare else []) +
+                      [self.repodir])
+        if alternates:
+            LOGGER.info("Borrowing objects from repository family '%s'",
+                        self.family.name)
+            git_dir = self.repodir if bare else os.path.join(self.repodir,
+                                                             '.git')
+            with open(os.path.join(git_dir, 'objects', 'info', 'alternates'),
+                      'w') as alternates_fp:
+                alternates_fp.write(alternates + '\n')
+        git_cmd(self.repodir, ['remote', 'add', 'origin', self.url])
+        git_cmd(self.repodir, ['config', 'remote.origin.fetch',
+                               '+refs/*:refs/*'])
+        fetch_args = ['fetch', '-q', '-u']
+        if self.depth:
+            LOGGER.info('Limiting history depth to %d', self.depth)
+            fetch_args.append('--depth=%d' % self.depth)
+        if self.clone_filter:
+            # Objects filtered out are fetched on demand from the remote
+            LOGGER.info('Using object filter %s', self.clone_filter)
+            for key, val in (('core.repositoryformatversion', '1'),
+                             ('extensions.partialclone', 'origin'),
+                             ('remote.origin.promisor', 'true'),
+                             ('remote.origin.partialclonefilter',
+                              self.clone_filter)):
+                git_cmd(self.repodir, ['config', key, val])
+            fetch_args.append('--filter=%s' % self.clone_filter)
+        git_cmd(self.repodir, fetch_args + ['origin'])
+        # Record remote HEAD in FETCH_HEAD, like MirrorGitRepository does
+        git_cmd(self.repodir, fetch_args + ['origin', 'HEAD'])
+
+    def get_config(self, key):
+        """Get a git config value of the cached clone, None if not set"""
+        try:
+            return git_cmd(self.repo.git_dir, ['config', '--get', key]).strip()
+        except GitRepositoryError:
+            return None
+
+    def is_shallow(self):
+        """Check if the cached clone has truncated history"""
+        return os.path.exists(os.path.join(self.repo.git_dir, 'shallow'))
+
+    def unshallow(self):
+        """Fetch the full history of a shallow clone"""
+        LOGGER.info('Fetching full history of the shallow clone')
+        if self.lock_shared:
+            # Not converted in place, that could deadlock with another run
+            # upgrading its lock
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            if not self.is_shallow():
+                LOGGER.info('Full history was just fetched by another '
+                            'service run')
+                return
+            git_cmd(self.repo.git_dir, ['fetch', '-q', '-u', '--unshallow',
+                                        'origin'])
+            self._update_state(size=None)
+        except GitRepositoryError as err:
+            raise CachedRepoError('Failed to unshallow: %s' % err)
+        finally:
+            if self.lock_shared:
+                fcntl.flock(self.lock, fcntl.LOCK_SH)
+
+    def fetch(self):
+        """Update the cached clone from the remote"""
+        LOGGER.info('Fetching from remote')
+        # Pushes done after the fetch has started may not be included
+        fetch_start = time.time()
+        try:
+            call_with_deadline(self._remote_timeout(), self.repo.force_fetch)
+        except (GitRepositoryError, ChildCallError) as err:
+            raise CachedRepoError('Failed to fetch from remote: %s' % err)
+        except DeadlineExceeded:
+            self.remove_git_locks()
+            raise CachedRepoTimeout('Fetch from remote timed out')
+        self.fetched = True
+        self._update_state(last_fetch=fetch_start, size=None)
+
+    def remove_git_locks(self):
+        """Remove lock files left behind by a killed git process, we hold
+        the repository lock so no-one else is using the clone"""
+        if self.lock_shared:
+            # Lock files may belong to other service runs
+            return
+        for dirpath, dirnames, filenames in os.walk(self.repo.git_dir):
+            if os.path.basename(dirpath) == 'objects':
+                dirnames[:] = []
+            for fname in filenames:
+                if fname.endswith('.lock'):
+                    LOGGER.debug('Removing stale git lock %s', fname)
+                    os.unlink(os.path.join(dirpath, fname))
+
+    def resolve(self, revision):
+        """Resolve a revision to a commit id without touching the working
+        copy"""
+        if revision == 'HEAD':
+            revision = self._local_ref('HEAD') or 'HEAD'
+        try:
+            return self.repo.rev_parse('%s^{commit}' % revision)
+        except GitRepositoryError as err:
+            raise CachedRepoError("Unknown ref '%s': %s" % (revision, err))
+
+    def share_lock(self):
+        """Downgrade to a shared lock, letting other service runs export from
+        the cached repository at the same time"""
+        fcntl.flock(self.lock, fcntl.LOCK_SH)
+        self.lock_shared = True
+
+    def prefetch(self, commit):
+        """Fetch the objects of the tree of commit missing from a partial
+        clone into the cached repository. Objects fetched lazily by an
+        export repository would be lost with it. Concurrent runs holding the
+        shared lock may fetch the same objects, which is harmless."""
+        try:
+            output = git_cmd(self.repo.git_dir, ['rev-list', '--objects',
+                                                 '--missing=print',
+                                                 '--no-walk', commit])
+            missing = [line[1:] for line in output.splitlines() if
+                            line.startswith('?')]
+            if not missing:
+                return
+            LOGGER.info('Fetching %d objects missing from the partial clone',
+                        len(missing))
+            clone_filter = self.get_config('remote.origin.partialclonefilter')
+            git_cmd(self.repo.git_dir, ['fetch', '-q', '--no-tags',
+                                        '--no-write-fetch-head',
+                                        '--recurse-submodules=no',
+                                        '--filter=%s' % (clone_filter or
+                                                         'blob:none'),
+                                        '--stdin', 'origin'],
+                    stdin='\n'.join(missing) + '\n')
+        except GitRepositoryError as err:
+            LOGGER.warning('Failed to fetch missing objects into the repo '
+                           'cache: %s', err)
+
+    def materialize(self, commit, path):
+        """Create a lightweight repository with commit checked out, borrowing
+        all objects from the cached repository"""
+        LOGGER.debug('Creating export repository %s', path)
+        try:
+            git_cmd(None, ['init', '-q', path])
+            dotgit = os.path.join(path, '.git')
+            with open(os.path.join(dotgit, 'objects', 'info', 'alternates'),
+                      'w') as alternates:
+                alternates.write(os.path.join(self.repo.git_dir, 'objects') +
+                                 '\n')
+            if self.is_shallow():
+                shutil.copy(os.path.join(self.repo.git_dir, 'shallow'),
+                            dotgit)
+            if self.get_config('extensions.partialclone'):
+                self.prefetch(commit)
+                # Lazily fetch other missing objects from the original remote
+                for key, val in (('core.repositoryformatversion', '1'),
+                                 ('extensions.partialclone', 'origin'),
+                                 ('remote.origin.url', self.url),
+                                 ('remote.origin.promisor', 'true')):
+                    git_cmd(path, ['config', key, val])
+            # All objects are found through alternates so fetching the
+            # branches and tags is cheap
+            git_cmd(path, ['fetch', '-q', '--update-head-ok',
+                           self.repo.git_dir, '+refs/heads/*:refs/heads/*',
+                           '+refs/tags/*:refs/tags/*'])
+            git_cmd(path, ['-c', 'advice.detachedHead=false', 'checkout', '-q',
+                           '--detach', commit])
+        except (GitRepositoryError, IOError) as err:
+            raise CachedRepoError('Failed to create export repository: %s' %
+                                  err)
+
+    def add_worktree(self, commit, path):
+        """Create a short-lived worktree with commit checked out, returns the
+        administrative directory of the worktree"""
+        LOGGER.debug('Creating worktree %s', path)
+        try:
+            # Clean up worktrees left behind by crashed service runs
+            git_cmd(self.repo.git_dir, ['worktree', 'prune'])
+            git_cmd(self.repo.git_dir, ['worktree', 'add', '--detach', path,
+                                        commit])
+            with open(os.path.join(path, '.git')) as dotgit:
+                return dotgit.read().split(':', 1)[1].strip()
+        except (GitRepositoryError, IOError, IndexError) as err:
+            raise CachedRepoError('Failed to create worktree: %s' % err)
+
+    def remove_worktree(self, path):
+        """Remove a worktree created with add_worktree()"""
+        LOGGER.debug('Removing worktree %s', path)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        try:
+            git_cmd(self.repo.git_dir, ['worktree', 'prune'])
+        except GitRepositoryError as err:
+            LOGGER.warning('Failed to prune worktrees: %s', err)
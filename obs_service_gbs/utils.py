@@ -0,0 +1,169 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Helper functions for the GBS source service"""
+
+import cPickle as pickle
+import errno
+import fcntl
+import os
+import select
+import signal
+import time
+
+
+class DeadlineExceeded(Exception):
+    """Function call did not finish in time"""
+    pass
+
+
+class ChildCallError(Exception):
+    """Function call in a child process ended without a usable result"""
+    pass
+
+
+def disk_usage(path):
+    """Total size of files under a directory, in bytes"""
+    size = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, fname)).st_size
+            except OSError:
+                pass
+    return size
+
+def close_fds(keep=()):
+    """Close all file descriptors except stdin, stdout, stderr and the ones
+    in keep"""
+    start = 3
+    for fd in sorted(keep):
+        if fd >= start:
+            os.closerange(start, fd)
+            start = fd + 1
+    os.closerange(start, os.sysconf('SC_OPEN_MAX'))
+
+def _kill_group(pid):
+    """Kill a process group and reap its leader"""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    os.waitpid(pid, 0)
+
+def _func_name(func):
+    """Name of a function for error messages"""
+    return getattr(func, '__name__', repr(func))
+
+def _picklable(value):
+    """Value itself if it can be pickled, its string representation
+    otherwise"""
+    try:
+        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return str(value)
+    return value
+
+def _picklable_error(err):
+    """Copy of an exception, of the same class, that can be pickled"""
+    try:
+        copy = err.__class__.__new__(err.__class__)
+        copy.args = tuple([_picklable(arg) for arg in err.args])
+        copy.__dict__.update((key, _picklable(val)) for key, val in
+                                getattr(err, '__dict__', {}).items())
+        # Make sure that the parent is able to unpickle it, too
+        pickle.loads(pickle.dumps(copy, pickle.HIGHEST_PROTOCOL))
+    except Exception: # pylint: disable=W0703
+        return ChildCallError('%s: %s' % (err.__class__.__name__, err))
+    return copy
+
+def call_with_deadline(timeout, func, *args, **kwargs):
+    """Call func in a forked child process, killing the child and all the
+    processes it started (e.g. git) if it has not finished in timeout
+    seconds. Returns the return value of func and re-raises its exceptions,
+    raises DeadlineExceeded on timeout and ChildCallError if the child dies
+    without a result. No deadline if timeout is zero."""
+    if not timeout:
+        return func(*args, **kwargs)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        os.setpgid(0, 0)
+        # Don't let processes started by func keep the pipe open
+        fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            try:
+                result = (True, func(*args, **kwargs))
+            except Exception as err: # pylint: disable=W0703
+                result = (False, err)
+            try:
+                data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                if result[0]:
+                    error = ChildCallError('Unable to pass the result of %s '
+                                           'to the parent process' %
+                                           _func_name(func))
+                else:
+                    error = _picklable_error(result[1])
+                data = pickle.dumps((False, error), pickle.HIGHEST_PROTOCOL)
+            with os.fdopen(write_fd, 'wb') as result_fp:
+                result_fp.write(data)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    # Set the process group here, too, in case the child has not done it,
+    # yet
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+    deadline = time.time() + timeout
+    chunks = []
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                _kill_group(pid)
+                raise DeadlineExceeded('Timed out after %d seconds' % timeout)
+            try:
+                ready = select.select([read_fd], [], [], remaining)[0]
+            except select.error as err:
+                if err[0] == errno.EINTR:
+                    continue
+                raise
+            if ready:
+                data = os.read(read_fd, 65536)
+                if not data:
+                    break
+                chunks.append(data)
+    finally:
+        os.close(read_fd)
+    status = os.waitpid(pid, 0)[1]
+    try:
+        success, value = pickle.loads(''.join(chunks))
+    except (EOFError, pickle.UnpicklingError, ValueError):
+        if os.WIFSIGNALED(status):
+            reason = 'was killed by signal %d' % os.WTERMSIG(status)
+        else:
+            reason = 'exited with code %d' % os.WEXITSTATUS(status)
+        raise ChildCallError('Child process running %s %s' %
+                             (_func_name(func), reason))
+    if not success:
+        raise value
+    return value
@@ -0,0 +1,335 @@
+# vim:fileencoding=utf-8:et:ts=4:sw=4:sts=4
+#
+# Copyright (C) 2013 Intel Corporation <markus.lehtonen@linux.intel.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+"""Persistent privilege-dropped GBS worker processes
+
+Forking, dropping privileges and setting up GBS for every export is
+expensive. In the daemon and batch modes the exports can instead be run in a
+pool of persistent worker processes that already run as the GBS user. The
+workers accept export jobs over a Unix socket, one job per connection, and
+are recycled after a configurable number of jobs or when their memory usage
+exceeds a threshold.
+"""
+
+import cPickle as pickle
+import errno
+import os
+import pwd
+import resource
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import traceback
+
+import gbp.log as gbplog
+
+from obs_service_gbs.utils import DeadlineExceeded, close_fds
+
+
+LOGGER = gbplog.getLogger('source_service')
+
+# The pool used by service runs, if any
+_POOL = None
+
+
+class WorkerJobError(Exception):
+    """Export job failed in a worker, cmd_error tells whether it was an
+    expected GBS error or a crash"""
+
+    def __init__(self, msg, cmd_error=False, tb=None):
+        super(WorkerJobError, self).__init__(msg)
+        self.cmd_error = cmd_error
+        self.traceback = tb or msg
+
+
+def drop_privileges(uid, gid):
+    """Switch to the given user and group"""
+    if (uid, gid) == (os.getuid(), os.getgid()):
+        return
+    os.setgroups([])
+    os.setgid(gid)
+    os.setuid(uid)
+    try:
+        os.environ['HOME'] = pwd.getpwuid(uid).pw_dir
+    except KeyError:
+        pass
+
+def run_job(func, job_args):
+    """Run one job in a worker, returns the result together with the output
+    of the job"""
+    output = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    os.dup2(output.fileno(), 1)
+    os.dup2(output.fileno(), 2)
+    try:
+        func(*job_args)
+        result = {'status': 'ok'}
+    except (Exception, SystemExit) as err: # pylint: disable=W0703
+        # GBS has been loaded by the job, if it got this far
+        from gitbuildsys.errors import CmdError
+        result = {'status': 'error',
+                  'cmd_error': isinstance(err, CmdError),
+                  'error': str(err),
+                  'traceback': traceback.format_exc()}
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        os.close(saved_fds[0])
+        os.close(saved_fds[1])
+    output.seek(0)
+    result['output'] = output.read()
+    output.close()
+    return result
+
+def run_job_forked(func, job_args):
+    """Run one job in a child forked from the worker, so that the global state
+    changed by the job (e.g. the GBS configuration) does not leak to later
+    jobs of the worker"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The child stays in the process group of the worker, so that killing
+        # the worker kills the job, too
+        os.close(read_fd)
+        try:
+            data = pickle.dumps(run_job(func, job_args),
+                                pickle.HIGHEST_PROTOCOL)
+            with os.fdopen(write_fd, 'wb') as result_fp:
+                result_fp.write(data)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as result_fp:
+        data = result_fp.read()
+    _pid, status = os.waitpid(pid, 0)
+    try:
+        return pickle.loads(data)
+    except (EOFError, pickle.UnpicklingError, ValueError):
+        return {'status': 'error',
+                'cmd_error': False,
+                'error': 'GBS job process died (status %d)' % status,
+                'traceback': '',
+                'output': ''}
+
+def worker_main(sock, func, uid, gid, max_jobs, max_rss):
+    """Main loop of a worker process"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Own process group, for killing the worker together with the processes
+    # started by a hung job
+    os.setpgid(0, 0)
+    # Don't let GBS, running unprivileged, access the sockets and files of
+    # the pool owner (e.g. the listening socket of the daemon)
+    close_fds([sock.fileno()])
+    drop_privileges(uid, gid)
+    parent = os.getppid()
+    # Wake up periodically to check that the pool owner is still alive
+    sock.settimeout(1.0)
+    jobs = 0
+    while os.getppid() == parent:
+        try:
+            conn, _addr = sock.accept()
+        except socket.timeout:
+            continue
+        except socket.error as err:
+            # Another worker may have taken the connection
+            if err.errno in (errno.EINTR, errno.EAGAIN):
+                continue
+            raise
+        conn.settimeout(None)
+        try:
+            try:
+                job_args = pickle.load(conn.makefile('rb'))
+            except (EOFError, pickle.UnpicklingError):
+                continue
+            wfile = conn.makefile('wb')
+            # Tell the caller who to kill if the job takes too long
+            pickle.dump(os.getpid(), wfile, pickle.HIGHEST_PROTOCOL)
+            wfile.flush()
+            result = run_job_forked(func, job_args)
+            jobs += 1
+            # Max RSS is in kilobytes, the largest of the worker itself and
+            # the job processes forked from it
+            maxrss = max(resource.getrusage(who).ru_maxrss for who in
+                         (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+            result['pid'] = os.getpid()
+            result['retire'] = bool((max_jobs and jobs >= max_jobs) or
+                                    (max_rss and maxrss * 1024 > max_rss))
+            pickle.dump(result, wfile, pickle.HIGHEST_PROTOCOL)
+            wfile.flush()
+        finally:
+            conn.close()
+        if result['retire']:
+            break
+
+
+class WorkerPool(object):
+    """Pool of persistent worker processes running a function as the given
+    user and group"""
+
+    def __init__(self, func, size, uid, gid, max_jobs=0, max_rss=0):
+        self.func = func
+        self.size = size
+        self.uid = uid
+        self.gid = gid
+        # Number of jobs and max RSS in bytes after which a worker is
+        # recycled, zero means unlimited
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+        self.owner = os.getpid()
+        self.workers = set()
+        self.sockdir = None
+        self.sock = None
+
+    @property
+    def path(self):
+        """Path of the worker socket"""
+        return os.path.join(self.sockdir, 'worker.sock')
+
+    def _spawn(self):
+        """Start a new worker process"""
+        pid = os.fork()
+        if pid == 0:
+            ret = 0
+            try:
+                worker_main(self.sock, self.func, self.uid, self.gid,
+                            self.max_jobs, self.max_rss)
+            except: # pylint: disable=W0702
+                traceback.print_exc()
+                ret = 1
+            finally:
+                os._exit(ret)
+        self.workers.add(pid)
+
+    def start(self):
+        """Start the workers"""
+        self.sockdir = tempfile.mkdtemp(prefix='gbs-workers_')
+        os.chmod(self.sockdir, 0700)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(64)
+        for _ in range(self.size):
+            self._spawn()
+        LOGGER.debug('Started %d GBS workers', self.size)
+
+    def maintain(self, retired=None):
+        """Reap exited workers and replace them with new ones, waits for the
+        retired worker to exit"""
+        if os.getpid() != self.owner:
+            return
+        for pid in list(self.workers):
+            try:
+                wpid, _status = os.waitpid(pid, 0 if pid == retired else
+                                                os.WNOHANG)
+            except OSError as err:
+                if err.errno != errno.ECHILD:
+                    raise
+                wpid = pid
+            if wpid:
+                LOGGER.debug('GBS worker %d exited', pid)
+                self.workers.discard(pid)
+        while len(self.workers) < self.size:
+            self._spawn()
+
+    def stop(self):
+        """Stop all workers"""
+        if os.getpid() != self.owner:
+            return
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers = set()
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        if self.sockdir:
+            shutil.rmtree(self.sockdir, ignore_errors=True)
+            self.sockdir = None
+
+    def _kill(self, pid):
+        """Kill a worker running a hung job"""
+        LOGGER.debug('Killing GBS worker %d', pid)
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.maintain(retired=pid)
+
+    def call(self, *args, **kwargs):
+        """Run a job in a worker, raises WorkerJobError if it fails. The
+        worker is killed and DeadlineExceeded raised if the job does not
+        finish in 'timeout' seconds."""
+        timeout = kwargs.get('timeout')
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = None
+        try:
+            conn.connect(self.path)
+            wfile = conn.makefile('wb')
+            pickle.dump(args, wfile, pickle.HIGHEST_PROTOCOL)
+            wfile.flush()
+            rfile = conn.makefile('rb')
+            pid = pickle.load(rfile)
+            if timeout:
+                conn.settimeout(timeout)
+            result = pickle.load(rfile)
+        except socket.timeout:
+            self._kill(pid)
+            raise DeadlineExceeded('Timed out after %d seconds' % timeout)
+        except (socket.error, EOFError, pickle.UnpicklingError) as err:
+            raise WorkerJobError('GBS worker died: %s' % err)
+        finally:
+            conn.close()
+        if result['retire']:
+            # Replace recycled worker if we own the pool, otherwise the
+            # owner takes care of it
+            self.maintain(retired=result['pid'])
+        sys.stdout.write(result['output'])
+        sys.stdout.flush()
+        if result['status'] != 'ok':
+            raise WorkerJobError(result['error'], result['cmd_error'],
+                                 result['traceback'])
+
+
+def get_pool():
+    """Get the worker pool of this process, None if not running"""
+    return _POOL
+
+def start_pool(func, size, uid, gid, max_jobs=0, max_rss=0):
+    """Start the worker pool used by service runs in this process and its
+    children"""
+    global _POOL # pylint: disable=W0603
+    stop_pool()
+    _POOL = WorkerPool(func, size, uid, gid, max_jobs, max_rss)
+    _POOL.start()
+    return _POOL
+
+def stop_pool():
+    """Stop the worker pool"""
+    global _POOL # pylint: disable=W0603
+    if _POOL:
+        _POOL.stop()
+        _POOL = None
@@ -64,6 +64,7 @@ rm -rf %{buildroot}%{python_sitelib}/*info
 %dir /usr/lib/obs
 %dir /usr/lib/obs/service
 /usr/lib/obs/service/*
+%{_bindir}/obs-service-gbs-*
 %{python_sitelib}/obs_service_gbs
 %dir %{_sysconfdir}/obs
 %dir %{_sysconfdir}/obs/services
@@ -39,5 +39,8 @@ setup(name='obs_service_gbs',
       packages=['obs_service_gbs'],
       data_files=[('/usr/lib/obs/service', ['service/gbs',
                                             'service/gbs.service']),
-                  ('/etc/obs/services', ['config/gbs'])],
+                  ('/etc/obs/services', ['config/gbs']),
+                  ('/usr/bin', ['tools/obs-service-gbs-daemon',
+                                'tools/obs-service-gbs-cache',
+                                'tools/obs-service-gbs-batch'])],
      )
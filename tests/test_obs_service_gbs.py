@@ -18,24 +18,44 @@
 # MA 02110-1301, USA.
 """Tests for the GBS source service"""
 
+import fcntl
 import glob
 import grp
 import mock
 import json
 import os
+import pstats
 import shutil
+import signal
 import stat
+import subprocess
+import sys
 import tempfile
+import time
+from StringIO import StringIO
 # pylint: disable=E0611
 from nose.tools import assert_raises, eq_, ok_
 
 from gbp.git.repository import GitRepository
+from gitbuildsys.cmd_export import main as cmd_export
+from gbp_repocache import CachedRepoError, MirrorGitRepository
 from obs_service_gbp_utils import GbpServiceError
 
-from obs_service_gbs.command import main as export_service
+import obs_service_gbs
+from obs_service_gbs import daemon
+from obs_service_gbs.batch import BatchRunner, group_jobs, read_jobs
+from obs_service_gbs.cachetool import main as cache_tool
+from obs_service_gbs.cacheindex import CacheIndex
+from obs_service_gbs.client import main as client_service
+from obs_service_gbs.command import (main as export_service, read_config,
+                start_worker_pool)
+from obs_service_gbs.repocache import (evict_repos, is_sharded,
+                iter_cached_repos)
+from obs_service_gbs.worker import get_pool, stop_pool
 
 
 TEST_DATA_DIR = os.path.abspath(os.path.join('tests', 'data'))
+TEST_PGRP = os.getpgrp()
 
 
 class MockGbsError(Exception):
@@ -50,14 +70,51 @@ def _mock_fork(*args, **kwargs):
     """Mock fork call function for testing crashes"""
     raise GbpServiceError(args, kwargs)
 
+def _counting_export(gbs_args):
+    """Export function recording its calls and taking its time"""
+    with open('export-calls', 'a') as calls_fp:
+        calls_fp.write('%s\n' % gbs_args.commit)
+    time.sleep(1)
+    return cmd_export(gbs_args)
 
+def _timed_export(gbs_args):
+    """Export function recording when it runs"""
+    start = time.time()
+    time.sleep(2)
+    ret = cmd_export(gbs_args)
+    with open('export-times', 'a') as times_fp:
+        times_fp.write('%f %f\n' % (start, time.time()))
+    return ret
 
-def service(argv=None):
+def _hanging_fetch(*_args, **_kwargs):
+    """Mock fetch that never finishes"""
+    time.sleep(60)
+
+def _hanging_export(_gbs_args):
+    """Mock export hanging in a git subprocess"""
+    child = subprocess.Popen(['sleep', '60'])
+    with open('export-child', 'w') as pid_fp:
+        pid_fp.write(str(child.pid))
+    child.wait()
+
+def _dying_export(_gbs_args):
+    """Mock export killing all the processes running the export"""
+    if os.getpgrp() != TEST_PGRP:
+        os.killpg(os.getpgrp(), signal.SIGKILL)
+    raise GbpServiceError('Export not running in its own process group')
+
+def _mock_fetch(*args, **kwargs):
+    """Mock repocache fetch for testing that fetch is not done"""
+    raise CachedRepoError('Fetch called with %s %s' % (args, kwargs))
+
+
+
+def service(argv=None, func=export_service):
     """Wrapper for service"""
     # Set non-existent config file so that user/system settings don't affect
     # tests
     dummy_conf = os.path.abspath(os.path.join(os.path.curdir, 'gbs.noconfig'))
-    return export_service(['--config', dummy_conf] + argv)
+    return func(['--config', dummy_conf] + argv)
 
 
 class UnitTestsBase(object):
@@ -278,3 +335,780 @@ class TestGbsService(UnitTestsBase):
 
         # Restore env
         del os.environ['OBS_GBS_REPO_CACHE_REFS_HACK']
+
+    def test_export_cache(self):
+        """Test the export cache"""
+        os.environ['OBS_GBS_EXPORT_CACHE_DIR'] = os.path.join(self.tmpdir,
+                                                              'export-cache')
+        try:
+            eq_(service(['--url', self.orig_repo.path, '--outdir=foo']), 0)
+            eq_(len([fname for fname in os.listdir('export-cache') if
+                        not fname.startswith('.')]), 1)
+            # Cached export must not run GBS
+            with mock.patch('obs_service_gbs.command.cmd_export',
+                            _mock_export):
+                eq_(service(['--url', self.orig_repo.path,
+                             '--outdir=bar']), 0)
+                # Different revision is not found in the cache
+                eq_(service(['--url', self.orig_repo.path,
+                             '--revision=master~1', '--outdir=baz']), 3)
+            eq_(sorted(os.listdir('foo')), sorted(os.listdir('bar')))
+        finally:
+            del os.environ['OBS_GBS_EXPORT_CACHE_DIR']
+
+    def test_sha_revision(self):
+        """Test that cached commits are exported without fetching"""
+        remote = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote)
+        sha = self.orig_repo.rev_parse('master')
+        eq_(service(['--url', remote, '--revision', sha, '--outdir=foo']), 0)
+        # Remote is not needed for commits found in the cache
+        shutil.rmtree(remote)
+        eq_(service(['--url', remote, '--revision', sha, '--outdir=bar']), 0)
+        eq_(sorted(os.listdir('foo')), sorted(os.listdir('bar')))
+        # Unknown commit causes a fetch which fails now
+        eq_(service(['--url', remote, '--revision', '1' * 40]), 1)
+
+    def test_fetch_ttl_config(self):
+        """Test the repo cache fetch TTL config option"""
+        remote = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote)
+        os.environ['OBS_GBS_REPO_CACHE_FETCH_TTL'] = '3600'
+        try:
+            eq_(service(['--url', remote, '--outdir=foo']), 0)
+            # Remote is not needed within the TTL
+            shutil.rmtree(remote)
+            eq_(service(['--url', remote, '--outdir=bar']), 0)
+            # Revisions not found in the cache are fetched within the TTL
+            shutil.copytree(self.orig_repo.path, remote)
+            GitRepository(remote).create_branch('new-branch')
+            eq_(service(['--url', remote, '--outdir=baz',
+                         '--revision=new-branch']), 0)
+            shutil.rmtree(remote)
+        finally:
+            del os.environ['OBS_GBS_REPO_CACHE_FETCH_TTL']
+        # Fetch fails without the TTL
+        eq_(service(['--url', remote]), 1)
+
+    def test_push_during_fetch(self):
+        """Test that a push during a fetch in progress is not missed"""
+        remote_path = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote_path)
+        remote = GitRepository(remote_path)
+        orig_fetch = MirrorGitRepository.force_fetch
+
+        def pushing_fetch(repo, *args, **kwargs):
+            """Fetch that is still running when a push lands"""
+            ret = orig_fetch(repo, *args, **kwargs)
+            self.update_repository_file(remote, 'foo.txt', 'pushed\n')
+            open('pushed', 'w').close()
+            time.sleep(1)
+            return ret
+
+        eq_(service(['--url', remote_path, '--outdir=foo']), 0)
+        pid = os.fork()
+        if pid == 0:
+            ret = 1
+            try:
+                with mock.patch('gbp_repocache.MirrorGitRepository.'
+                                'force_fetch', pushing_fetch):
+                    ret = service(['--url', remote_path, '--outdir=bar'])
+            finally:
+                os._exit(ret)
+        for _ in range(100):
+            if os.path.exists('pushed'):
+                break
+            time.sleep(0.1)
+        # Run started after the push must see it
+        eq_(service(['--url', remote_path, '--outdir=baz',
+                     '--git-meta=_meta']), 0)
+        eq_(os.waitpid(pid, 0)[1], 0)
+        with open('baz/_meta') as meta_fp:
+            ok_(remote.rev_parse('master') in meta_fp.read())
+
+    def test_repo_cache_swr(self):
+        """Test serving stale cached refs with a background refresh"""
+        remote_path = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote_path)
+        remote = GitRepository(remote_path)
+        os.environ['OBS_GBS_REPO_CACHE_SWR'] = '3600'
+        try:
+            eq_(service(['--url', remote_path, '--outdir=foo']), 0)
+            repodir = list(iter_cached_repos(self.cachedir))[0]
+            orig_head = remote.rev_parse('master')
+            self.update_repository_file(remote, 'foo.txt', 'more data\n')
+            # Cached refs are used, without waiting for a fetch
+            eq_(service(['--url', remote_path, '--outdir=bar',
+                         '--revision=master', '--git-meta=_meta']), 0)
+            with open('bar/_meta') as meta_fp:
+                ok_(orig_head in meta_fp.read())
+            # Background refresh updates the cache
+            for _ in range(100):
+                if GitRepository(repodir).rev_parse('master') != orig_head:
+                    break
+                time.sleep(0.1)
+            eq_(GitRepository(repodir).rev_parse('master'),
+                remote.rev_parse('master'))
+            eq_(service(['--url', remote_path, '--outdir=baz',
+                         '--revision=master', '--git-meta=_meta']), 0)
+            with open('baz/_meta') as meta_fp:
+                ok_(remote.rev_parse('master') in meta_fp.read())
+        finally:
+            del os.environ['OBS_GBS_REPO_CACHE_SWR']
+
+    def test_offline_fallback(self):
+        """Test exporting from the cache when the remote is unreachable"""
+        remote = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote)
+        metrics_fn = os.path.join(self.tmpdir, 'metrics.json')
+        eq_(service(['--url', remote, '--outdir=foo']), 0)
+        shutil.rmtree(remote)
+        eq_(service(['--url', remote, '--outdir=bar']), 1)
+        os.environ['OBS_GBS_REPO_CACHE_OFFLINE_FALLBACK'] = 'yes'
+        os.environ['OBS_GBS_METRICS_FILE'] = metrics_fn
+        try:
+            for rev in ('HEAD', 'master', 'v0.1'):
+                eq_(service(['--url', remote, '--outdir=' + rev,
+                             '--revision', rev]), 0)
+            # Revision must be found in the cache
+            eq_(service(['--url', remote, '--revision=foobar']), 1)
+            # Hanging fetch is aborted
+            shutil.copytree(self.orig_repo.path, remote)
+            os.environ['OBS_GBS_REPO_CACHE_FETCH_TIMEOUT'] = '1'
+            with mock.patch('gbp_repocache.MirrorGitRepository.force_fetch',
+                            _hanging_fetch):
+                start = time.time()
+                eq_(service(['--url', remote, '--outdir=baz']), 0)
+                ok_(time.time() - start < 30)
+        finally:
+            del os.environ['OBS_GBS_REPO_CACHE_OFFLINE_FALLBACK']
+            del os.environ['OBS_GBS_METRICS_FILE']
+            os.environ.pop('OBS_GBS_REPO_CACHE_FETCH_TIMEOUT', None)
+        with open(metrics_fn) as metrics_fp:
+            eq_([json.loads(line)['offline_fallback'] for line in metrics_fp],
+                [True, True, True, False, True])
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2'],
+                         directory='baz')
+
+    def test_ls_remote_config(self):
+        """Test the ls-remote pre-check config option"""
+        remote_path = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote_path)
+        remote = GitRepository(remote_path)
+        os.environ['OBS_GBS_REPO_CACHE_LS_REMOTE'] = 'yes'
+        try:
+            eq_(service(['--url', remote_path, '--outdir=foo']), 0)
+            # No fetch for unchanged refs
+            with mock.patch('obs_service_gbs.repocache.ServiceCachedRepo.'
+                            'fetch', _mock_fetch):
+                for rev in ('HEAD', 'master', 'v0.1'):
+                    eq_(service(['--url', remote_path, '--outdir=bar',
+                                 '--revision', rev]), 0)
+            # Changed ref is fetched
+            self.update_repository_file(remote, 'foo.txt', 'more data\n')
+            eq_(service(['--url', remote_path, '--outdir=baz',
+                         '--revision=master', '--git-meta=_meta']), 0)
+            with open('baz/_meta') as meta_fp:
+                ok_(remote.rev_parse('master') in meta_fp.read())
+        finally:
+            del os.environ['OBS_GBS_REPO_CACHE_LS_REMOTE']
+
+    def test_export_mode_config(self):
+        """Test the export-mode config option"""
+        os.environ['OBS_GBS_EXPORT_MODE'] = 'objects'
+        try:
+            eq_(service(['--url', self.orig_repo.path,
+                         '--git-meta=_git_meta']), 0)
+            self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2',
+                              '_git_meta'])
+            # Cached repository is bare
+            eq_(glob.glob(self.cachedir + '/*/*/.git'), [])
+            eq_(len(glob.glob(self.cachedir + '/*/*/objects')), 1)
+            eq_(service(['--url', self.orig_repo.path, '--revision=v0.1~1',
+                         '--outdir=foo']), 2)
+            eq_(service(['--url', self.orig_repo.path, '--revision=foobar',
+                         '--outdir=foo']), 1)
+            # Worktree mode
+            os.environ['OBS_GBS_EXPORT_MODE'] = 'worktree'
+            eq_(service(['--url', self.orig_repo.path, '--outdir=bar']), 0)
+            eq_(sorted(os.listdir('bar')),
+                ['test-package-0.1.tar.bz2', 'test-package.spec'])
+            eq_(service(['--url', self.orig_repo.path, '--revision=v0.1~1',
+                         '--outdir=bar']), 2)
+            # Worktrees are removed after export
+            eq_(glob.glob(self.cachedir + '/*/*/worktrees/*'), [])
+            os.environ['OBS_GBS_EXPORT_MODE'] = 'foobar'
+            eq_(service(['--url', self.orig_repo.path, '--outdir=foo']), 1)
+        finally:
+            del os.environ['OBS_GBS_EXPORT_MODE']
+
+    def test_concurrent_exports(self):
+        """Test that exports from a bare cached repo run concurrently"""
+        os.environ['OBS_GBS_EXPORT_MODE'] = 'objects'
+        try:
+            eq_(service(['--url', self.orig_repo.path]), 0)
+            pids = []
+            with mock.patch('obs_service_gbs.command.cmd_export',
+                            _timed_export):
+                for rev in ('master', 'v0.1'):
+                    commit = self.orig_repo.rev_parse(rev + '^{commit}')
+                    pid = os.fork()
+                    if pid == 0:
+                        ret = 1
+                        try:
+                            ret = service(['--url', self.orig_repo.path,
+                                           '--revision', commit,
+                                           '--outdir', rev])
+                        finally:
+                            os._exit(ret)
+                    pids.append(pid)
+            for pid in pids:
+                eq_(os.waitpid(pid, 0)[1], 0)
+        finally:
+            del os.environ['OBS_GBS_EXPORT_MODE']
+        with open('export-times') as times_fp:
+            times = [[float(val) for val in line.split()] for line in times_fp]
+        eq_(len(times), 2)
+        # The exports overlap
+        ok_(max([start for start, _end in times]) <
+            min([end for _start, end in times]))
+
+    def test_options_clone_depth(self):
+        """Test the --clone-depth and --clone-filter options"""
+        eq_(service(['--url', self.orig_repo.path, '--clone-depth=1',
+                     '--clone-filter=blob:none']), 0)
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2'])
+        with assert_raises(SystemExit):
+            service(['--url', self.orig_repo.path, '--clone-depth=foo'])
+
+    def test_partial_clone_objects_mode(self):
+        """Test that blobs missing from a partial clone are cached"""
+        remote = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote)
+        for key in ('uploadpack.allowFilter', 'uploadpack.allowAnySHA1InWant'):
+            subprocess.check_call(['git', 'config', key, 'true'], cwd=remote)
+        os.environ['OBS_GBS_EXPORT_MODE'] = 'objects'
+        try:
+            eq_(service(['--url', remote, '--clone-filter=blob:none',
+                         '--outdir=foo']), 0)
+        finally:
+            del os.environ['OBS_GBS_EXPORT_MODE']
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2'],
+                         directory='foo')
+        repodir = list(iter_cached_repos(self.cachedir))[0]
+        output = subprocess.check_output(['git', 'rev-list', '--objects',
+                                          '--missing=print', '--no-walk',
+                                          'master'], cwd=repodir)
+        eq_([line for line in output.splitlines() if line.startswith('?')],
+            [])
+
+    def test_repo_cache_eviction(self):
+        """Test eviction of repositories from the cache"""
+        remote = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote)
+        eq_(service(['--url', self.orig_repo.path, '--outdir=foo']), 0)
+        eq_(service(['--url', remote, '--outdir=bar']), 0)
+        repos = list(iter_cached_repos(self.cachedir))
+        eq_(len(repos), 2)
+
+        # Cache is within limits
+        eq_(evict_repos(self.cachedir, 1024**3, 0), [])
+        # Locked repositories are not evicted
+        with open(repos[0] + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            eq_(evict_repos(self.cachedir, 1, 0), [repos[1]])
+        eq_(list(iter_cached_repos(self.cachedir)), [repos[0]])
+        # Evicted repository is re-cloned
+        eq_(service(['--url', remote, '--outdir=baz']), 0)
+        eq_(len(list(iter_cached_repos(self.cachedir))), 2)
+
+    def test_metrics_config(self):
+        """Test the metrics-file config option"""
+        os.environ['OBS_GBS_METRICS_FILE'] = os.path.join(self.tmpdir,
+                                                          'metrics.json')
+        try:
+            eq_(service(['--url', self.orig_repo.path, '--outdir=foo',
+                         '--git-meta=_git_meta']), 0)
+            eq_(service(['--url', self.orig_repo.path, '--outdir=foo',
+                         '--revision=foobar']), 1)
+        finally:
+            del os.environ['OBS_GBS_METRICS_FILE']
+        with open('metrics.json') as metrics_fp:
+            records = [json.loads(line) for line in metrics_fp]
+        eq_(len(records), 2)
+        eq_(records[0]['exit_code'], 0)
+        eq_(records[0]['revision'], self.orig_repo.rev_parse('master'))
+        eq_([phase['name'] for phase in records[0]['phases']],
+            ['config', 'fetch', 'checkout', 'export-prepare', 'export', 'move',
+             'git-meta', 'evict'])
+        ok_(records[0]['phases'][4]['child_maxrss'] > 0)
+        eq_(records[1]['exit_code'], 1)
+
+    def test_options_profile(self):
+        """Test the --profile option"""
+        profdir = os.path.join(self.tmpdir, 'profile')
+        eq_(service(['--url', self.orig_repo.path, '--outdir=foo',
+                     '--profile', profdir]), 0)
+        sha = self.orig_repo.rev_parse('master')
+        profiles = sorted(os.listdir(profdir))
+        eq_(len(profiles), 2)
+        ok_(profiles[0].endswith('%s-gbs.prof' % sha))
+        ok_(profiles[1].endswith('%s-service.prof' % sha))
+        # Profiles must be readable and the GBS profile must cover export
+        stats = pstats.Stats(os.path.join(profdir, profiles[0]))
+        ok_([func for func in stats.stats if func[2] == 'main'])
+        pstats.Stats(os.path.join(profdir, profiles[1]))
+        # Profiling enabled in config
+        shutil.rmtree(profdir)
+        os.environ['OBS_GBS_PROFILE_DIR'] = profdir
+        try:
+            eq_(service(['--url', self.orig_repo.path, '--outdir=foo']), 0)
+        finally:
+            del os.environ['OBS_GBS_PROFILE_DIR']
+        eq_(len(os.listdir(profdir)), 2)
+
+    def test_batch(self):
+        """Test the batch mode"""
+        jobs = [{'url': self.orig_repo.path, 'outdir': 'foo'},
+                {'url': self.orig_repo.path, 'outdir': 'bar',
+                 'revision': 'v0.1', 'options': {'git-meta': '_git_meta'}},
+                {'url': self.orig_repo.path, 'outdir': 'baz',
+                 'revision': 'v0.1~1'},
+                {'url': self.orig_repo.path}]
+        with open('jobs.json', 'w') as jobs_fp:
+            for job in jobs:
+                jobs_fp.write(json.dumps(job) + '\n')
+            jobs_fp.write('invalid json\n')
+        with open('jobs.json') as jobs_fp:
+            jobs = read_jobs(jobs_fp)
+        eq_(len(jobs), 5)
+        eq_(len(group_jobs(jobs)), 1)
+        output = StringIO()
+        dummy_conf = os.path.abspath('gbs.noconfig')
+        results = BatchRunner([dummy_conf], 2, output=output).run(jobs)
+        eq_(sorted([(res['index'], res['exit_code']) for res in results]),
+            [(0, 0), (1, 0), (2, 2), (3, 1), (4, 1)])
+        eq_([json.loads(line) for line in output.getvalue().splitlines()],
+            results)
+        ok_(os.path.exists('foo/test-package.spec'))
+        ok_(os.path.exists('bar/_git_meta'))
+        eq_(os.listdir('baz'), [])
+        ok_(results[-1]['phases'])
+
+    def test_gbs_workers(self):
+        """Test exporting in persistent GBS workers"""
+        os.environ['OBS_GBS_GBS_WORKERS'] = '1'
+        os.environ['OBS_GBS_GBS_WORKER_MAX_JOBS'] = '2'
+        private = open('private', 'w')
+        try:
+            pool = start_worker_pool(read_config([]))
+        finally:
+            del os.environ['OBS_GBS_GBS_WORKERS']
+            del os.environ['OBS_GBS_GBS_WORKER_MAX_JOBS']
+        try:
+            worker = list(pool.workers)[0]
+            eq_(service(['--url', self.orig_repo.path, '--outdir=foo']), 0)
+            # Files of the pool owner are not inherited by the workers
+            fd_dir = '/proc/%d/fd' % worker
+            ok_(os.path.abspath('private') not in
+                [os.readlink(os.path.join(fd_dir, fd)) for fd in
+                    os.listdir(fd_dir)])
+            self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2'],
+                             directory='foo')
+            eq_(service(['--url', self.orig_repo.path, '--outdir=bar',
+                         '--revision', 'v0.1~1']), 2)
+            # Worker is recycled after max jobs, the new worker sees the mock
+            with mock.patch('obs_service_gbs.command.cmd_export',
+                            _mock_export):
+                for _ in range(100):
+                    pool.maintain()
+                    if worker not in pool.workers:
+                        break
+                    time.sleep(0.05)
+                ok_(worker not in pool.workers)
+                eq_(len(pool.workers), 1)
+                eq_(service(['--url', self.orig_repo.path, '--outdir=baz']),
+                    3)
+        finally:
+            stop_pool()
+            private.close()
+        ok_(get_pool() is None)
+
+    def test_gbs_workers_config(self):
+        """Test that the GBS config of a project does not leak to later
+        exports in the same worker"""
+        # Repository with packaging files in a non-default directory
+        shutil.copytree(TEST_DATA_DIR, 'other')
+        os.rename(os.path.join('other', 'packaging'),
+                  os.path.join('other', 'rpm'))
+        with open(os.path.join('other', '.gbs.conf'), 'w') as conf_fp:
+            conf_fp.write('[general]\npackaging_dir = rpm\n')
+        other_repo = GitRepository.create('other')
+        other_repo.add_files(os.listdir('other'))
+        other_repo.commit_staged('Initial version')
+
+        os.environ['OBS_GBS_GBS_WORKERS'] = '1'
+        try:
+            pool = start_worker_pool(read_config([]))
+        finally:
+            del os.environ['OBS_GBS_GBS_WORKERS']
+        try:
+            worker = list(pool.workers)[0]
+            eq_(service(['--url', other_repo.path, '--outdir=foo']), 0)
+            self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2'],
+                             directory='foo')
+            eq_(service(['--url', self.orig_repo.path, '--outdir=bar']), 0)
+            self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2'],
+                             directory='bar')
+            # Both exports were run by the same worker
+            eq_(pool.workers, set([worker]))
+        finally:
+            stop_pool()
+
+    def test_single_flight(self):
+        """Test that identical concurrent exports run GBS only once"""
+        os.environ['OBS_GBS_EXPORT_MODE'] = 'objects'
+        pids = []
+        try:
+            # Populate the repository cache
+            eq_(service(['--url', self.orig_repo.path, '--revision=v0.1',
+                         '--outdir=pre']), 0)
+            # Results are not stored if nobody waits for them
+            exports_dir = os.path.join(self.cachedir, '.exports')
+            eq_(os.listdir(exports_dir), ['.locks'])
+            eq_(os.listdir(os.path.join(exports_dir, '.locks')), [])
+            with mock.patch('obs_service_gbs.command.cmd_export',
+                            _counting_export):
+                for outdir in ('foo', 'bar'):
+                    pid = os.fork()
+                    if pid == 0:
+                        ret = 1
+                        try:
+                            ret = service(['--url', self.orig_repo.path,
+                                           '--outdir=%s' % outdir])
+                        finally:
+                            os._exit(ret)
+                    pids.append(pid)
+        finally:
+            del os.environ['OBS_GBS_EXPORT_MODE']
+        eq_([os.waitpid(pid, 0)[1] for pid in pids], [0, 0])
+        eq_(sorted(os.listdir('foo')),
+            ['test-package-0.1.tar.bz2', 'test-package.spec'])
+        eq_(sorted(os.listdir('foo')), sorted(os.listdir('bar')))
+        with open('export-calls') as calls_fp:
+            eq_(len(calls_fp.readlines()), 1)
+
+    def test_single_flight_checkout(self):
+        """Test identical concurrent exports in the checkout mode"""
+        pids = []
+        with mock.patch('obs_service_gbs.command.cmd_export',
+                        _counting_export):
+            for outdir in ('foo', 'bar'):
+                pid = os.fork()
+                if pid == 0:
+                    ret = 1
+                    try:
+                        ret = service(['--url', self.orig_repo.path,
+                                       '--outdir=%s' % outdir])
+                    finally:
+                        os._exit(ret)
+                pids.append(pid)
+        eq_([os.waitpid(pid, 0)[1] for pid in pids], [0, 0])
+        eq_(sorted(os.listdir('foo')),
+            ['test-package-0.1.tar.bz2', 'test-package.spec'])
+        eq_(sorted(os.listdir('foo')), sorted(os.listdir('bar')))
+        # Runs are serialized by the repository lock and both run GBS,
+        # without the overhead of sharing exports in progress
+        with open('export-calls') as calls_fp:
+            eq_(len(calls_fp.readlines()), 2)
+        ok_(not os.path.exists(os.path.join(self.cachedir, '.exports')))
+
+    def test_cache_index(self):
+        """Test the index of the repository cache"""
+        remote = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote)
+        eq_(service(['--url', self.orig_repo.path, '--outdir=foo']), 0)
+        index = CacheIndex(self.cachedir)
+        # Index is not used before it has been built from the cache
+        eq_(index.entries(), None)
+        eq_(service(['list'], cache_tool), 0)
+        repos = index.entries()
+        eq_(repos.keys(), list(iter_cached_repos(self.cachedir)))
+        state = repos.values()[0]
+        eq_(state['url'], self.orig_repo.path)
+        ok_(state['size'] > 0)
+        ok_(state['last_export'] >= state['last_fetch'])
+        # Service runs update the index
+        eq_(service(['--url', remote, '--outdir=bar']), 0)
+        eq_(sorted(index.entries().keys()),
+            sorted(iter_cached_repos(self.cachedir)))
+        # Eviction uses and updates the index
+        eq_(service(['evict', '--high-watermark=1', '--low-watermark=0'],
+                    cache_tool), 0)
+        eq_(index.entries(), {})
+        # Rebuild
+        eq_(service(['--url', remote, '--outdir=baz']), 0)
+        index.rebuild({})
+        eq_(service(['reindex'], cache_tool), 0)
+        eq_(index.entries().keys(), list(iter_cached_repos(self.cachedir)))
+        index.close()
+
+    def test_cache_prewarm(self):
+        """Test pre-warming the repository cache"""
+        with open('_service', 'w') as service_fp:
+            service_fp.write('<services>\n'
+                             '  <service name="gbs">\n'
+                             '    <param name="url">%s</param>\n'
+                             '  </service>\n'
+                             '  <service name="foo">\n'
+                             '    <param name="url">bar</param>\n'
+                             '  </service>\n'
+                             '</services>\n' % self.orig_repo.path)
+        eq_(service(['prewarm', '_service', self.orig_repo.path, '-j', '2'],
+                    cache_tool), 0)
+        eq_(len(list(iter_cached_repos(self.cachedir))), 1)
+        # Export does not need to clone anymore
+        eq_(service(['--url', self.orig_repo.path]), 0)
+        eq_(len(list(iter_cached_repos(self.cachedir))), 1)
+        eq_(service(['prewarm', 'non-existent-repo'], cache_tool), 1)
+
+    def test_url_canonicalization(self):
+        """Test that aliases of a repository share one cached clone"""
+        remote = os.path.join(self.tmpdir, 'remote')
+        shutil.copytree(self.orig_repo.path, remote)
+        os.symlink(remote, remote + '.git')
+        mirror = os.path.join(self.tmpdir, 'mirror')
+        shutil.copytree(self.orig_repo.path, mirror)
+        os.environ['OBS_GBS_REPO_CACHE_URL_ALIASES'] = '%s %s' % (mirror,
+                                                                 remote)
+        os.environ['OBS_GBS_REPO_CACHE_URL_STRIP_GIT_SUFFIX'] = 'yes'
+        try:
+            eq_(service(['--url', remote, '--outdir=foo']), 0)
+            eq_(service(['--url', remote + '.git', '--outdir=bar']), 0)
+            # Remote is fetched from the requested URL
+            mirror_repo = GitRepository(mirror)
+            self.update_repository_file(mirror_repo, 'foo.txt', 'mirror\n')
+            eq_(service(['--url', mirror, '--outdir=baz',
+                         '--git-meta=_meta']), 0)
+            with open('baz/_meta') as meta_fp:
+                ok_(mirror_repo.rev_parse('master') in meta_fp.read())
+            os.environ['OBS_GBS_REPO_CACHE_URL_ALIASES'] = 'foo'
+            eq_(service(['--url', remote, '--outdir=foo']), 1)
+        finally:
+            del os.environ['OBS_GBS_REPO_CACHE_URL_ALIASES']
+            del os.environ['OBS_GBS_REPO_CACHE_URL_STRIP_GIT_SUFFIX']
+        eq_(len(list(iter_cached_repos(self.cachedir))), 1)
+
+    def test_repo_families(self):
+        """Test repository families sharing an object store"""
+        fork = os.path.join(self.tmpdir, 'fork1')
+        shutil.copytree(self.orig_repo.path, fork)
+        self.update_repository_file(GitRepository(fork), 'foo.txt', 'fork\n')
+        with open('family.conf', 'w') as conf:
+            conf.write('[general]\n'
+                       '[family test]\n'
+                       'base = %s\n'
+                       'members = %s/fork*\n' % (self.orig_repo.path,
+                                                  self.tmpdir))
+        eq_(service(['--url', fork, '--config', 'family.conf',
+                     '--outdir=fork']), 0)
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2'],
+                         directory='fork')
+        family_dir = os.path.join(self.cachedir, '.families', 'test.git')
+        ok_(os.path.isdir(family_dir))
+        alternates = glob.glob(os.path.join(self.cachedir, '*', '*',
+                                            '.git/objects/info/alternates'))
+        eq_(len(alternates), 1)
+        with open(alternates[0]) as alternates_fp:
+            eq_(alternates_fp.read().strip(),
+                os.path.join(family_dir, 'objects'))
+        # Non-members do not use the family
+        eq_(service(['--url', self.orig_repo.path, '--config', 'family.conf',
+                     '--outdir=foo']), 0)
+        eq_(len(glob.glob(os.path.join(self.cachedir, '*', '*',
+                                       '.git/objects/info/alternates'))), 1)
+        # Invalid family
+        with open('family.conf', 'a') as conf:
+            conf.write('[family foo]\n')
+        eq_(service(['--url', fork, '--config', 'family.conf']), 1)
+
+    def test_cache_migrate(self):
+        """Test migrating the repository cache into the sharded layout"""
+        eq_(service(['--url', self.orig_repo.path, '--outdir=foo']), 0)
+        flat_repodir = list(iter_cached_repos(self.cachedir))[0]
+        # Layout must be changed before migrating
+        eq_(service(['migrate'], cache_tool), 1)
+        os.environ['OBS_GBS_REPO_CACHE_LAYOUT'] = 'sharded'
+        try:
+            # Repositories of the flat layout are still used
+            eq_(service(['--url', self.orig_repo.path, '--outdir=bar']), 0)
+            eq_(list(iter_cached_repos(self.cachedir)), [flat_repodir])
+            eq_(service(['migrate'], cache_tool), 0)
+            repodirs = list(iter_cached_repos(self.cachedir))
+            eq_(len(repodirs), 1)
+            ok_(is_sharded(self.cachedir, repodirs[0]))
+            ok_(not os.path.exists(os.path.dirname(flat_repodir)))
+            eq_(service(['--url', self.orig_repo.path, '--outdir=baz',
+                         '--revision=v0.1']), 0)
+            eq_(list(iter_cached_repos(self.cachedir)), repodirs)
+            os.environ['OBS_GBS_REPO_CACHE_LAYOUT'] = 'foo'
+            eq_(service(['--url', self.orig_repo.path]), 1)
+        finally:
+            del os.environ['OBS_GBS_REPO_CACHE_LAYOUT']
+
+    def test_options_skip_unchanged(self):
+        """Test the --skip-unchanged option"""
+        args = ['--url', self.orig_repo.path, '--git-meta=_meta',
+                '--skip-unchanged=yes', '--outdir=foo']
+        eq_(service(args), 0)
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2',
+                          '_meta', '.gbs-export-state'], directory='foo')
+        with open('foo/test-package.spec', 'a') as spec_fp:
+            spec_fp.write('# modified\n')
+        # Files are left untouched
+        with mock.patch('obs_service_gbs.command.cmd_export', _mock_export):
+            eq_(service(args), 0)
+        with open('foo/test-package.spec') as spec_fp:
+            ok_(spec_fp.read().endswith('# modified\n'))
+        # Different revision is exported
+        eq_(service(args + ['--revision=v0.1']), 0)
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2',
+                          '_meta', '.gbs-export-state'], directory='foo')
+        with open('foo/test-package.spec') as spec_fp:
+            ok_(not spec_fp.read().endswith('# modified\n'))
+        # Missing files are re-exported
+        os.unlink('foo/test-package-0.1.tar.bz2')
+        eq_(service(args + ['--revision=v0.1']), 0)
+        ok_(os.path.exists('foo/test-package-0.1.tar.bz2'))
+        # Only plain file names of the state file are removed
+        open('victim', 'w').close()
+        with open('foo/.gbs-export-state') as state_fp:
+            state = json.load(state_fp)
+        for fname in ('../victim', os.path.abspath('victim')):
+            state['files'].append(fname)
+            with open('foo/.gbs-export-state', 'w') as state_fp:
+                json.dump(state, state_fp)
+            eq_(service(args + ['--revision=v0.1']), 0)
+            ok_(os.path.exists('victim'))
+            state['files'].remove(fname)
+        # Not used without git-meta
+        eq_(service(['--url', self.orig_repo.path, '--skip-unchanged=yes',
+                     '--outdir=bar']), 0)
+        ok_(not os.path.exists('bar/.gbs-export-state'))
+
+    def test_lazy_imports(self):
+        """Test that GBS and git-buildpackage are not loaded at startup"""
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+                                os.path.abspath(obs_service_gbs.__file__)))
+        code = ('import sys\n'
+                'from obs_service_gbs import command\n'
+                'print [name for name in command.LAZY_MODULES if name in '
+                'sys.modules]\n')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env)
+        eq_(output.strip(), '[]')
+
+    def test_export_deadline(self):
+        """Test killing a hung export"""
+        os.environ['OBS_GBS_EXPORT_DEADLINE'] = '1'
+        try:
+            with mock.patch('obs_service_gbs.command.cmd_export',
+                            _hanging_export):
+                start = time.time()
+                eq_(service(['--url', self.orig_repo.path]), 4)
+                ok_(time.time() - start < 30)
+                # Subprocesses of GBS are killed, too
+                with open('export-child') as pid_fp:
+                    child_pid = int(pid_fp.read())
+                for _ in range(50):
+                    try:
+                        os.kill(child_pid, 0)
+                    except OSError:
+                        break
+                    time.sleep(0.1)
+                else:
+                    ok_(False, 'Export subprocess was not killed')
+                eq_(service(['--url', self.orig_repo.path, '--outdir=foo',
+                             '--error-pkg=4']), 0)
+                self.check_files(['service-error.spec', 'service-error'],
+                                 directory='foo')
+            # Sudden death of the export is a GBS crash
+            with mock.patch('obs_service_gbs.command.cmd_export',
+                            _dying_export):
+                eq_(service(['--url', self.orig_repo.path, '--outdir=bar',
+                             '--error-pkg=3']), 0)
+                self.check_files(['service-error.spec', 'service-error'],
+                                 directory='bar')
+        finally:
+            del os.environ['OBS_GBS_EXPORT_DEADLINE']
+
+
+class TestDaemon(UnitTestsBase):
+    """Tests for the service daemon"""
+
+    def __init__(self):
+        super(TestDaemon, self).__init__()
+        self.socket = None
+        self.daemon_pid = None
+
+    def setup(self):
+        """Test case setup"""
+        super(TestDaemon, self).setup()
+        self.socket = os.path.join(self.tmpdir, 'daemon.sock')
+        os.environ['OBS_GBS_DAEMON_SOCKET'] = self.socket
+
+    def teardown(self):
+        """Test case teardown"""
+        if self.daemon_pid:
+            os.kill(self.daemon_pid, signal.SIGTERM)
+            os.waitpid(self.daemon_pid, 0)
+            self.daemon_pid = None
+        del os.environ['OBS_GBS_DAEMON_SOCKET']
+        super(TestDaemon, self).teardown()
+
+    def start_daemon(self, config=None):
+        """Start daemon in a child process"""
+        self.daemon_pid = os.fork()
+        if self.daemon_pid == 0:
+            try:
+                daemon.ServiceDaemon(self.socket, config).serve()
+            finally:
+                os._exit(0)
+        for _ in range(100):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.05)
+        ok_(os.path.exists(self.socket))
+
+    def test_fallback(self):
+        """Test that the client runs the service without the daemon"""
+        eq_(service(['--url', self.orig_repo.path], client_service), 0)
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2'])
+
+    def test_daemon_export(self):
+        """Test export through the daemon"""
+        self.start_daemon()
+        eq_(service(['--url', self.orig_repo.path], client_service), 0)
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2',
+                          'daemon.sock'])
+        # Errors are relayed to the client, too
+        eq_(service(['--url', self.orig_repo.path, '--revision=foobar'],
+                    client_service), 1)
+        eq_(service(['--url', self.orig_repo.path, '--outdir=foo',
+                     '--error-pkg=1', '--revision=foobar'], client_service), 0)
+        self.check_files(['service-error.spec', 'service-error'],
+                         directory='foo')
+
+    def test_daemon_workers(self):
+        """Test export through the daemon with persistent GBS workers"""
+        os.environ['OBS_GBS_GBS_WORKERS'] = '2'
+        try:
+            self.start_daemon(read_config([]))
+        finally:
+            del os.environ['OBS_GBS_GBS_WORKERS']
+        eq_(service(['--url', self.orig_repo.path], client_service), 0)
+        self.check_files(['test-package.spec', 'test-package-0.1.tar.bz2',
+                          'daemon.sock'])
+        eq_(service(['--url', self.orig_repo.path, '--outdir=foo',
+                     '--revision', 'v0.1~1'], client_service), 2)